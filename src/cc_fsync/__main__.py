@@ -25,14 +25,25 @@ Author: Shailendra Dharmistan, Zcaler Inc.
 
 import argparse
 import logging
+import sys
 from logging.handlers import RotatingFileHandler
-from cc_fsync.sync import run_copy_process, settings
+
+# The manifest subcommand only reads local state; dispatch it before the settings and cloud detection
+if len(sys.argv) > 1 and sys.argv[1] == 'manifest':
+    from cc_fsync import manifest
+    sys.exit(manifest.main(sys.argv[2:]))
+
+from cc_fsync.sync import (run_copy_process, close_connections, copy_files_from_vm_limited, discover_vms,
+                           release_vm, invalidate_cloud_environment, start_lifecycle_events, stop_lifecycle_events,
+                           base_local_dir, max_concurrency, settings)
+from cc_fsync import transfer
+from cc_fsync.cycle import CycleCoordinator
+from cc_fsync.scheduler import VMScheduler
 import schedule
 import time
 import daemon
 import signal
 import subprocess
-import sys
 
 # Configuration for logging
 log_level = settings['logging'].get('log_level', 'INFO')
@@ -51,8 +62,25 @@ logger.addHandler(handler)
 # Get the interval from sync_script.py
 interval = settings.get('interval', 60)
 
-# Schedule the copy process to run periodically
-schedule.every(interval).seconds.do(run_copy_process)
+# 'cycle' copies all VMs together on every interval, 'per_vm' schedules every VM on its own
+scheduling = settings.get('scheduling', 'cycle')
+coordinator = None
+vm_scheduler = None
+if scheduling == 'per_vm':
+    vm_scheduler = VMScheduler(discover_vms, lambda vm_info: copy_files_from_vm_limited(vm_info, base_local_dir),
+                               interval, max_concurrency, settings.get('schedule_jitter', 0.1), release_vm)
+elif scheduling == 'cycle':
+    # Start a copy cycle on every interval without letting overrunning cycles pile up
+    try:
+        coordinator = CycleCoordinator(run_copy_process, interval, settings.get('overlap_policy', 'skip'))
+    except ValueError as policy_error:
+        logger.critical("Invalid settings: %s", policy_error)
+        sys.exit(1)
+    # Schedule the copy process to run periodically
+    schedule.every(interval).seconds.do(coordinator.tick)
+else:
+    logger.critical("Invalid settings: unsupported scheduling '%s', expected 'cycle' or 'per_vm'", scheduling)
+    sys.exit(1)
 
 # Flag to indicate if the daemon should stop
 should_stop = False
@@ -62,13 +90,31 @@ def signal_handler(signum, frame):
     global should_stop
     logger.info(f"Received signal {signum}. Shutting down gracefully...")
     should_stop = True
+    # Kill any rsync that is still running so the current cycle ends promptly
+    transfer.cancel_all()
+
+# Signal handler to probe the cloud environment again
+def reload_handler(signum, frame):
+    logger.info(f"Received signal {signum}. The cloud environment will be detected again on the next cycle")
+    invalidate_cloud_environment()
 
 def main():
     # Main loop to keep the script running and executing the scheduled tasks
     logger.info("Starting cc-fsync...")
+    start_lifecycle_events()
     while not should_stop:
-        schedule.run_pending()
+        if vm_scheduler:
+            vm_scheduler.run_pending()
+        else:
+            schedule.run_pending()
         time.sleep(1)
+    # Running transfers were cancelled by the signal handler, wait for the copies to wind down
+    if vm_scheduler:
+        vm_scheduler.stop()
+    else:
+        coordinator.stop(timeout=30)
+    stop_lifecycle_events()
+    close_connections()
     logger.info("Stopping cc-fsync...")
 
 # Argument parsing
@@ -83,7 +129,8 @@ if args.daemon:
         files_preserve=[handler.stream],
         signal_map={
             signal.SIGTERM: signal_handler,
-            signal.SIGINT: signal_handler
+            signal.SIGINT: signal_handler,
+            signal.SIGHUP: reload_handler
         }
     ):
         main()
@@ -98,5 +145,6 @@ else:
     # Run in the foreground
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
     main()
 
@@ -0,0 +1,219 @@
+"""
+This module implements the 'asyncio' concurrency model.
+
+Transfers are started with asyncio.create_subprocess_exec, so a single thread can drive
+thousands of rsync/ssh processes. The number of VMs copied at the same time is bounded by a
+semaphore (max_concurrency) and by the slots shared with the rest of the process (see limits.py).
+Processes are registered with the transfer module, so transfer.cancel_all() cancels them exactly
+like the ones started by the thread and gevent models.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import asyncio
+import logging
+import shlex
+import concurrent.futures
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cc_fsync import limits, transfer
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+
+# Function to stop a running process and all of its children
+async def terminate_process(process):
+    """
+    Terminate a process group started by run_command with transfer.terminate_process
+    Parameters:
+    - process: The asyncio.subprocess.Process object to terminate
+    """
+    loop = asyncio.get_running_loop()
+
+    def wait(timeout):
+        # The exit status is collected by the event loop, which keeps running meanwhile
+        future = asyncio.run_coroutine_threadsafe(process.wait(), loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # Only an alias of the builtin TimeoutError from Python 3.11 on
+            future.cancel()
+            raise TimeoutError()
+
+    # A VM only holds a worker of the default pool while it plans or runs a backend transfer,
+    # so a worker is free for the VM terminating its command
+    await loop.run_in_executor(None, transfer.terminate_process, process, wait)
+
+
+# Function to run a command with a deadline
+async def run_command(argv, timeout=None, parse_output=transfer.parse_rsync_bytes):
+    """
+    Run a command from an argv list without blocking the event loop
+    Parameters:
+    - argv: The command and its arguments as a list
+    - timeout: The maximum number of seconds the command may run, or None for no limit
+    - parse_output: A function returning the number of bytes moved from the command stdout
+    Returns:
+    - A result dictionary (see transfer.new_result)
+    """
+    result = transfer.new_result(argv)
+    if transfer.is_cancelled():
+        result['cancelled'] = True
+        return result
+
+    start = time.monotonic()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL, start_new_session=True)
+    except OSError as os_error:
+        result['error'] = str(os_error)
+        return result
+
+    if not transfer.track_process(process):
+        await terminate_process(process)
+        result['cancelled'] = True
+        return result
+
+    communicate = asyncio.ensure_future(process.communicate())
+    try:
+        try:
+            stdout, stderr = await asyncio.wait_for(asyncio.shield(communicate), timeout)
+        except asyncio.TimeoutError:
+            result['timed_out'] = True
+            await terminate_process(process)
+            stdout, stderr = await communicate
+        except asyncio.CancelledError:
+            # Don't leave the rsync/ssh process group running once nothing tracks it anymore
+            await terminate_process(process)
+            await communicate
+            raise
+    finally:
+        transfer.untrack_process(process)
+
+    stdout = stdout.decode(errors='replace')
+    stderr = stderr.decode(errors='replace')
+    result['duration'] = time.monotonic() - start
+    result['exit_code'] = process.returncode
+    result['cancelled'] = transfer.is_cancelled() and process.returncode != 0
+    if parse_output:
+        result['bytes_transferred'] = parse_output(stdout)
+    if process.returncode != 0:
+        result['error'] = stderr.strip()[-2000:] or None
+    return result
+
+
+# Function to copy the files of one VM
+async def copy_files_from_vm(vm_info, plan_transfers, semaphore, group_limiter, shared_limiter, host_locks,
+                             timeout=None, on_vm_done=None):
+    """
+    Plan the transfers of a VM and run them one after another
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - plan_transfers: A function taking a vm_info and returning the transfers to run for it
+    - semaphore: The semaphore bounding the number of VMs copied at the same time
+    - group_limiter: The limits.AsyncGroupLimiter bounding the VMs per zone/subnet
+    - shared_limiter: The limits.GroupLimiter shared with the other copies of the process
+    - host_locks: The limits.HostLocks of the process
+    - timeout: The deadline of every single transfer in seconds
+    - on_vm_done: An optional function called with vm_info once the VM is done
+    Returns:
+    - A list of transfer results
+    """
+    results = []
+    try:
+        # Wait for the VM and the zone/subnet slot first, so that waiting VMs don't hold a global slot.
+        # The slots of this event loop come before the shared ones, so only the VMs that would run
+        # now wait for a push copy or another cycle.
+        async with limits.acquire_async(host_locks.get(vm_info['hostname'])), group_limiter.hold(vm_info), \
+                semaphore, shared_limiter.hold_async(vm_info):
+            loop = asyncio.get_running_loop()
+            try:
+                # Planning may ask the VM what changed; keep that off the event loop
+                plans = await loop.run_in_executor(None, plan_transfers, vm_info)
+                for plan in plans:
+                    if not transfer.can_run(plan, results):
+                        logger.info("Skipping %s of %s, not every transfer succeeded",
+                                    ', '.join(plan['remote_paths']), vm_info['hostname'])
+                        continue
+                    logger.info("Running command: %s", shlex.join(plan['command']))
+                    if 'run' in plan:
+                        # Backends without a command block; run them on the default thread pool
+                        result = await loop.run_in_executor(None, plan['run'], timeout)
+                    else:
+                        result = await run_command(plan['command'], timeout=timeout)
+                    # on_success functions may hash files, keep them off the event loop too
+                    await loop.run_in_executor(None, transfer.complete_plan, plan, result)
+                    result.update(hostname=vm_info['hostname'], remote_paths=plan['remote_paths'],
+                                  local=plan.get('local', False))
+                    transfer.log_result(result)
+                    results.append(result)
+                    if result['cancelled']:
+                        break
+            except Exception as r_error:
+                result = transfer.new_result([])
+                result.update(hostname=vm_info['hostname'], remote_paths=list(vm_info['remote_paths']),
+                              error=str(r_error))
+                transfer.log_result(result)
+                results.append(result)
+    finally:
+        if on_vm_done:
+            on_vm_done(vm_info)
+    return results
+
+
+# Function to copy the files of all VMs
+async def copy_files_from_vms(vm_list, plan_transfers, max_concurrency, shared_limiter, host_locks,
+                              concurrency_limits=None, timeout=None, on_vm_done=None):
+    """
+    Copy the files of all VMs concurrently
+    Parameters:
+    - vm_list: The list of VMs to copy
+    - plan_transfers: A function taking a vm_info and returning the transfers to run for it
+    - max_concurrency: The maximum number of VMs copied at the same time
+    - shared_limiter: The limits.GroupLimiter shared with the other copies of the process
+    - host_locks: The limits.HostLocks of the process
+    - concurrency_limits: The validated concurrency_limits setting (per zone/subnet caps)
+    - timeout: The deadline of every single transfer in seconds
+    - on_vm_done: An optional function called with the vm_info of every VM once it is done
+    Returns:
+    - A list of transfer results of all VMs
+    """
+    # Size the default pool so every concurrent VM can plan or run a backend transfer at the same time
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='cc-fsync-async'))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    group_limiter = limits.AsyncGroupLimiter(concurrency_limits or {})
+    tasks = [copy_files_from_vm(vm_info, plan_transfers, semaphore, group_limiter, shared_limiter, host_locks,
+                                timeout, on_vm_done)
+             for vm_info in vm_list]
+    results = []
+    # A failing VM must not cancel the others, which would leave their transfers half done
+    for vm_info, vm_results in zip(vm_list, await asyncio.gather(*tasks, return_exceptions=True)):
+        if isinstance(vm_results, BaseException):
+            logger.error("Failed to copy files from %s: %s", vm_info['hostname'], vm_results)
+            continue
+        results.extend(vm_results)
+    return results
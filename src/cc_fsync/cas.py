@@ -0,0 +1,223 @@
+"""
+This module deduplicates the copied files of all VMs in a content-addressable object store.
+
+Most configuration files are byte-identical across the fleet but are stored once per VM. After a
+successful transfer, every file of the copied paths that is not deduplicated yet is hashed and
+replaced by a hardlink to its object in the store, so identical files use one inode and one copy
+of the data. Hardlinks share their metadata, hence an object is keyed by the SHA-256 of the
+content plus the mtime, mode and owner that rsync preserves; files that only differ in metadata
+get separate objects and rsync never sees a wrong mtime. Files that already have more than one
+link are skipped, so only the files changed by the last transfer are hashed. rsync replaces a
+changed file by renaming a new file over it, which leaves the shared object untouched. It changes
+the permissions, the owner and, with --checksum, the mtime of an unchanged file in place though,
+i.e. for every VM sharing the object: repair() gives such a file a copy of its own and restores
+the metadata of the object. Paths whose content is modified in place (tail transfers, --inplace
+or --append-verify profiles) must not be deduplicated. Objects that are not linked from any VM
+anymore are removed by gc().
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Bytes read at once while hashing
+HASH_CHUNK_SIZE = 1024 * 1024
+# Minimum number of seconds between two garbage collections of the store
+GC_INTERVAL = 3600
+
+
+# Function to hash the content of a local file
+def hash_file(path):
+    """
+    Return the hex SHA-256 digest of a local file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f_stream:
+        for block in iter(lambda: f_stream.read(HASH_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ContentStore:
+    """
+    Object store holding one hardlinked copy of every distinct file
+    Parameters:
+    - directory: The object directory. It must be on the same file system as base_local_dir.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._last_gc = time.monotonic()
+        self._gc_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def object_path(self, path, file_stat):
+        """
+        Return the object of a local file, keyed by its content and the metadata shared by hardlinks
+        """
+        key = (f"{hash_file(path)}-{int(file_stat.st_mtime)}-{stat.S_IMODE(file_stat.st_mode):o}"
+               f"-{file_stat.st_uid}-{file_stat.st_gid}")
+        return os.path.join(self.directory, key[:2], key[2:4], key)
+
+    def find_object(self, path, file_stat):
+        """
+        Return the object a local file is linked to, or None
+        """
+        file_hash = hash_file(path)
+        directory = os.path.join(self.directory, file_hash[:2], file_hash[2:4])
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            object_path = os.path.join(directory, name)
+            if name.startswith(f"{file_hash}-") and os.path.samestat(os.lstat(object_path), file_stat):
+                return object_path
+        return None
+
+    def repair(self, local_path, since):
+        """
+        Undo the metadata changes a transfer made in place on objects shared with other VMs
+        Parameters:
+        - local_path: The local copy of a remote path
+        - since: The time the transfer started; only the files whose inode changed afterwards are checked
+        Returns:
+        - The number of files that got a copy of their own
+        """
+        repaired = 0
+        for root, _, names in os.walk(local_path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    file_stat = os.lstat(path)
+                    # Linking the object from another VM changes its ctime too, hence the check of the key
+                    if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_nlink == 1 or file_stat.st_ctime < since:
+                        continue
+                    object_path = self.find_object(path, file_stat)
+                    if object_path and self._unshare(path, file_stat, object_path):
+                        repaired += 1
+                except OSError as repair_error:
+                    logger.warning("Failed to repair the metadata of %s: %s", path, repair_error)
+        return repaired
+
+    def _unshare(self, path, file_stat, object_path):
+        mtime, mode, uid, gid = os.path.basename(object_path).split('-')[1:]
+        expected = (int(mtime), int(mode, 8), int(uid), int(gid))
+        if expected == (int(file_stat.st_mtime), stat.S_IMODE(file_stat.st_mode), file_stat.st_uid, file_stat.st_gid):
+            return False
+        # Copy on write: the file keeps the metadata set by the transfer, on a copy of its own
+        tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.cc-fsync-copy")
+        shutil.copyfile(path, tmp_path)
+        os.chown(tmp_path, file_stat.st_uid, file_stat.st_gid)
+        os.chmod(tmp_path, stat.S_IMODE(file_stat.st_mode))
+        os.utime(tmp_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+        os.replace(tmp_path, path)
+        # The other VMs get back the metadata their copies had; chown first, it may clear setuid bits
+        os.chown(object_path, expected[2], expected[3])
+        os.chmod(object_path, expected[1])
+        os.utime(object_path, (file_stat.st_atime, expected[0]))
+        logger.info("Metadata of %s changed in place, gave it a copy of its own", path)
+        return True
+
+    def ingest(self, local_path):
+        """
+        Replace the files below a local directory by hardlinks into the store
+        Parameters:
+        - local_path: The local copy of a remote path
+        Returns:
+        - The number of files that were hashed and the number of bytes saved
+        """
+        hashed = saved = 0
+        for root, _, names in os.walk(local_path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    file_stat = os.lstat(path)
+                    # Symlinks, special files and files already linked into the store
+                    if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_nlink > 1:
+                        continue
+                    hashed += 1
+                    saved += self._link(path, file_stat)
+                except OSError as link_error:
+                    # e.g. the file was replaced by a concurrent push transfer; retried next time
+                    logger.debug("Failed to deduplicate %s: %s", path, link_error)
+        return hashed, saved
+
+    def _link(self, path, file_stat):
+        object_path = self.object_path(path, file_stat)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        try:
+            # First copy of this content: the file itself becomes the object
+            os.link(path, object_path)
+            return 0
+        except FileExistsError:
+            pass
+        # Link the object next to the file and rename it over the file, which is atomic
+        tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.cc-fsync-link")
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.link(object_path, tmp_path)
+        os.replace(tmp_path, path)
+        return file_stat.st_size
+
+    def maybe_gc(self):
+        """
+        Run gc() if the previous run is older than GC_INTERVAL
+        """
+        if not self._gc_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._last_gc >= GC_INTERVAL:
+                self._last_gc = time.monotonic()
+                self.gc()
+        finally:
+            self._gc_lock.release()
+
+    def gc(self):
+        """
+        Remove the objects that are no longer linked from any VM
+        Returns:
+        - The number of objects removed
+        """
+        removed = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    if os.lstat(path).st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            logger.info("Removed %d unused object(s) from %s", removed, self.directory)
+        return removed
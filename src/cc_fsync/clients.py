@@ -0,0 +1,134 @@
+"""
+This module keeps long-lived AWS and Azure SDK clients shared by all discovery functions.
+
+Building a boto3 client resolves credentials, loads the endpoint and service models and sets up
+a new connection pool, which is expensive when done on every cycle. Clients are created once per
+(service, region) from one boto3 session per region, and Azure clients once per subscription
+from a single DefaultAzureCredential. Both SDKs refresh their credentials lazily when they are
+about to expire; reset() drops everything if a client has to be rebuilt after an auth error.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import threading
+
+import boto3
+from azure.identity import DefaultAzureCredential
+from azure.mgmt.compute import ComputeManagementClient
+from azure.mgmt.network import NetworkManagementClient
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# boto3 sessions are not thread safe, so clients are only created while holding the lock.
+# The clients themselves are thread safe and shared.
+_lock = threading.Lock()
+_aws_sessions = {}
+_aws_clients = {}
+_azure_credential = None
+_azure_clients = {}
+
+
+# Function to get a shared AWS client
+def get_aws_client(service, region, endpoint_url=None):
+    """
+    Get the shared boto3 client of a service in a region, creating it on first use
+    Parameters:
+    - service: The AWS service name, e.g. 'ec2' or 'autoscaling'
+    - region: The AWS region
+    - endpoint_url: An optional endpoint, e.g. a local stand-in used for testing
+    Returns:
+    - The boto3 client
+    """
+    key = (service, region, endpoint_url)
+    with _lock:
+        client = _aws_clients.get(key)
+        if client is None:
+            session = _aws_sessions.get(region)
+            if session is None:
+                session = _aws_sessions[region] = boto3.session.Session(region_name=region)
+            logger.debug("Creating AWS %s client for %s", service, region)
+            client = _aws_clients[key] = session.client(service, region_name=region, endpoint_url=endpoint_url)
+        return client
+
+
+# Function to get the shared Azure credential
+def get_azure_credential():
+    """
+    Get the shared DefaultAzureCredential, creating it on first use
+    """
+    global _azure_credential
+    with _lock:
+        if _azure_credential is None:
+            _azure_credential = DefaultAzureCredential()
+        return _azure_credential
+
+
+# Function to get a shared Azure management client
+def get_azure_client(client_class, subscription_id):
+    """
+    Get the shared Azure management client of a subscription, creating it on first use
+    Parameters:
+    - client_class: ComputeManagementClient or NetworkManagementClient
+    - subscription_id: The Azure subscription id
+    Returns:
+    - The management client
+    """
+    credential = get_azure_credential()
+    key = (client_class, subscription_id)
+    with _lock:
+        client = _azure_clients.get(key)
+        if client is None:
+            logger.debug("Creating Azure %s for subscription %s", client_class.__name__, subscription_id)
+            client = _azure_clients[key] = client_class(credential, subscription_id)
+        return client
+
+
+# Function to get the shared Azure compute client
+def get_compute_client(subscription_id):
+    """
+    Get the shared ComputeManagementClient of a subscription
+    """
+    return get_azure_client(ComputeManagementClient, subscription_id)
+
+
+# Function to get the shared Azure network client
+def get_network_client(subscription_id):
+    """
+    Get the shared NetworkManagementClient of a subscription
+    """
+    return get_azure_client(NetworkManagementClient, subscription_id)
+
+
+# Function to drop all shared clients
+def reset():
+    """
+    Drop all shared clients and credentials; they are created again on next use
+    """
+    global _azure_credential
+    with _lock:
+        _aws_sessions.clear()
+        _aws_clients.clear()
+        _azure_clients.clear()
+        _azure_credential = None
@@ -0,0 +1,171 @@
+"""
+This module coordinates the periodic copy cycles.
+
+Every scheduler tick starts a cycle in a background thread, so the main loop keeps running
+(and keeps handling signals) while VMs are being copied. If a tick fires while the previous
+cycle is still running, the overlap_policy setting decides what happens:
+- 'skip': the tick is skipped. Skipped ticks are coalesced into a single catch-up cycle
+  that starts as soon as the running cycle finishes.
+- 'partial': a new cycle is started right away for the VMs that are not being copied
+  anymore, so one slow VM doesn't delay every other VM by a full interval. Overlapping
+  cycles share the max_concurrency and zone/subnet caps of the process (see limits.py).
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import threading
+import time
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Supported values of the overlap_policy setting
+OVERLAP_POLICIES = ('skip', 'partial')
+
+
+class CycleCoordinator:
+    """
+    Start copy cycles on every tick without letting them pile up
+    Parameters:
+    - run_cycle: The function running one cycle. It is called with the keyword arguments
+      vm_filter (a function selecting the VMs to copy from the discovered list) and
+      on_vm_done (a function to call with the vm_info of every VM that finished).
+    - interval: The number of seconds between two ticks
+    - policy: The overlap policy, 'skip' or 'partial'
+    """
+
+    def __init__(self, run_cycle, interval, policy='skip'):
+        if policy not in OVERLAP_POLICIES:
+            raise ValueError(f"Unsupported overlap_policy '{policy}', expected one of {', '.join(OVERLAP_POLICIES)}")
+        self.run_cycle = run_cycle
+        self.interval = interval
+        self.policy = policy
+        self.cycle_id = 0
+        self.missed_ticks = 0
+        self._in_flight = set()
+        self._threads = []
+        self._last_start = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def running(self):
+        """
+        Return True if a cycle is still running
+        """
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            return bool(self._threads)
+
+    def tick(self):
+        """
+        Called by the scheduler on every interval
+        """
+        if not self.running():
+            self._start()
+            return
+        if self.policy == 'partial':
+            logger.warning("Previous copy cycle is still running (%d VMs in flight), "
+                           "starting a partial cycle for the other VMs", len(self._in_flight))
+            self._start()
+            return
+        with self._lock:
+            self.missed_ticks += 1
+        logger.warning("Previous copy cycle overran the interval of %ss, %d tick(s) coalesced",
+                       self.interval, self.missed_ticks)
+
+    def claim(self, vm_list):
+        """
+        Select the VMs that are not being copied by another cycle and mark them in flight
+        Parameters:
+        - vm_list: The discovered list of VMs
+        Returns:
+        - The VMs this cycle should copy
+        """
+        with self._lock:
+            claimed = [vm_info for vm_info in vm_list if vm_info['hostname'] not in self._in_flight]
+            self._in_flight.update(vm_info['hostname'] for vm_info in claimed)
+        skipped = len(vm_list) - len(claimed)
+        if skipped:
+            logger.info("Skipping %d VM(s) still being copied by a previous cycle", skipped)
+        return claimed
+
+    def release(self, vm_info):
+        """
+        Mark a VM as finished
+        """
+        with self._lock:
+            self._in_flight.discard(vm_info['hostname'])
+
+    def _start(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._stopped:
+                return
+            self.cycle_id += 1
+            cycle_id = self.cycle_id
+            if self._last_start is not None:
+                lateness = now - self._last_start - self.interval
+                if lateness >= 1:
+                    logger.info("Copy cycle %d starts %.1fs late", cycle_id, lateness)
+            self._last_start = now
+            thread = threading.Thread(target=self._run, args=(cycle_id,), name=f"cc-fsync-cycle-{cycle_id}")
+            self._threads.append(thread)
+        thread.start()
+
+    def _run(self, cycle_id):
+        start = time.monotonic()
+        logger.info("Starting copy cycle %d", cycle_id)
+        try:
+            self.run_cycle(vm_filter=self.claim, on_vm_done=self.release)
+        except Exception as cycle_error:
+            logger.error("Copy cycle %d failed: %s", cycle_id, cycle_error)
+        duration = time.monotonic() - start
+        if duration > self.interval:
+            logger.warning("Copy cycle %d took %.1fs, longer than the interval of %ss",
+                           cycle_id, duration, self.interval)
+        with self._lock:
+            catch_up = self.missed_ticks > 0
+            self.missed_ticks = 0
+        if catch_up:
+            # Run the coalesced ticks as a single cycle instead of waiting for the next tick
+            self._start()
+
+    def stop(self, timeout=None):
+        """
+        Stop starting new cycles and wait for the running cycles to finish
+        Parameters:
+        - timeout: The maximum number of seconds to wait
+        """
+        with self._lock:
+            self._stopped = True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                threads = [thread for thread in self._threads if thread.is_alive()]
+            if not threads:
+                return
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            threads[0].join(remaining)
+            if deadline is not None and time.monotonic() >= deadline:
+                return
@@ -0,0 +1,136 @@
+"""
+This module detects with one cheap ssh command whether the remote paths of a VM changed at all.
+
+Every rsync walks the complete remote tree under sudo, even on the many VMs where nothing happened
+since the previous cycle. Before the transfers of a VM, a single ssh command lists the name, size
+and mtime of everything below each remote path and reduces the listing to a checksum per path.
+Paths whose checksum matches the manifest saved after their last successful transfer are skipped;
+a VM where no path changed is not copied at all.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import os
+import shlex
+import threading
+
+from cc_fsync import state, transfer
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Prints one "<crc> <length>" line per argument: the cksum of the sorted "name size mtime" listing
+# of everything below the path, with GNU or BSD stat
+DIGEST_SCRIPT = ('for p; do { find "$p" -exec stat -c "%n %s %Y" {} + 2>/dev/null || '
+                 'find "$p" -exec stat -f "%N %z %m" {} + 2>/dev/null; } | LC_ALL=C sort | cksum; done')
+# Seconds the digest command may run
+DIGEST_TIMEOUT = 60
+
+
+# Function to build the remote digest command
+def build_digest_command(ssh_command, sudo_path, remote_paths):
+    """
+    Build the ssh command printing the digest of every remote path
+    Parameters:
+    - ssh_command: The ssh command including the destination, as a list of arguments
+    - sudo_path: The path of sudo on the VM
+    - remote_paths: The remote paths of the VM
+    Returns:
+    - The command as a list of arguments
+    """
+    return ssh_command + [shlex.join([sudo_path, 'sh', '-c', DIGEST_SCRIPT, 'sh', *remote_paths])]
+
+
+# Function to get the current digests of the remote paths of a VM
+def get_remote_digests(ssh_command, sudo_path, remote_paths, timeout=DIGEST_TIMEOUT):
+    """
+    Run the digest command on a VM
+    Parameters:
+    - ssh_command: The ssh command including the destination, as a list of arguments
+    - sudo_path: The path of sudo on the VM
+    - remote_paths: The remote paths of the VM
+    - timeout: The maximum number of seconds the command may run
+    Returns:
+    - A dictionary mapping every remote path to its digest, or None if the command failed
+    """
+    digests = {}
+
+    def parse_digests(output):
+        lines = [line.strip() for line in (output or '').splitlines() if line.strip()]
+        if len(lines) == len(remote_paths):
+            digests.update(zip(remote_paths, lines))
+        return 0
+
+    result = transfer.run_command(build_digest_command(ssh_command, sudo_path, remote_paths), timeout=timeout,
+                                  parse_output=parse_digests)
+    if not transfer.succeeded(result) or not digests:
+        if not result['cancelled']:
+            logger.warning("Change detection failed on %s, copying all paths: %s",
+                           ssh_command[-1], result['error'] or 'unexpected output')
+        return None
+    return digests
+
+
+class DigestManifest:
+    """
+    Digests of the remote paths of every VM as of their last successful transfer
+    Parameters:
+    - directory: The directory holding one JSON manifest per VM
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def path(self, hostname):
+        """
+        Return the path of the manifest of a VM
+        """
+        return os.path.join(self.directory, f"{hostname}.json")
+
+    def changed_paths(self, hostname, digests):
+        """
+        Return the remote paths whose digest differs from the manifest
+        Parameters:
+        - hostname: The hostname of the VM
+        - digests: The current digests, as returned by get_remote_digests
+        """
+        saved = state.read_json(self.path(hostname), {})
+        return [remote_path for remote_path, digest in digests.items() if saved.get(remote_path) != digest]
+
+    def save(self, hostname, digests):
+        """
+        Record the digests of remote paths that were copied successfully
+        """
+        # The transfers of one VM may finish from different threads
+        with self._lock:
+            saved = state.read_json(self.path(hostname), {})
+            saved.update(digests)
+            state.write_json(self.path(hostname), saved)
+
+    def remove(self, hostname):
+        """
+        Forget the manifest of a VM
+        """
+        state.remove(self.path(hostname))
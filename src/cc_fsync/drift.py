@@ -0,0 +1,103 @@
+"""
+This module reports the VMs whose configuration drifted away from the rest of the fleet.
+
+The report is built from the manifest (see manifest.py), which already holds the hash of every
+copied file and only hashes the files a cycle changed, so no file is read again here. For every
+remote path in the drift_paths setting, the VMs are grouped by the fingerprint of their files
+below that path. The largest group is the baseline; every other VM is an outlier and is listed
+with the files that differ from, are missing from or were added to the baseline.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import time
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Maximum number of files listed per outlier and kind of difference, to keep the report compact
+MAX_FILES = 20
+
+
+# Function to compare the files of a VM with the baseline
+def diff_files(baseline, files):
+    """
+    Compare two {path: hash} dictionaries
+    Returns:
+    - A dictionary with the changed, missing and extra paths, each capped at MAX_FILES
+    """
+    changed = sorted(path for path, file_hash in files.items() if path in baseline and baseline[path] != file_hash)
+    missing = sorted(path for path in baseline if path not in files)
+    extra = sorted(path for path in files if path not in baseline)
+    return {
+        'changed': changed[:MAX_FILES],
+        'missing': missing[:MAX_FILES],
+        'extra': extra[:MAX_FILES],
+        'counts': {'changed': len(changed), 'missing': len(missing), 'extra': len(extra)},
+    }
+
+
+# Function to build the drift report of one remote path
+def path_report(manifest, remote_path):
+    """
+    Group the VMs by the content of a remote path and describe the outliers
+    Parameters:
+    - manifest: The manifest.Manifest of the copied files
+    - remote_path: The remote directory, e.g. /etc/janus
+    Returns:
+    - A dictionary with the number of hosts and groups, the baseline and the outliers
+    """
+    groups = manifest.compare(remote_path)
+    report = {'hosts': sum(len(hosts) for _, hosts in groups), 'groups': len(groups), 'baseline': None, 'outliers': []}
+    if not groups:
+        return report
+    baseline_fingerprint, baseline_hosts = groups[0]
+    report['baseline'] = {'fingerprint': baseline_fingerprint, 'hosts': len(baseline_hosts)}
+    baseline = {path: file_hash for path, _, _, file_hash, _ in manifest.files(min(baseline_hosts), remote_path)}
+    for fingerprint, hosts in groups[1:]:
+        # All hosts of a group have the same files, one of them is enough for the difference
+        files = {path: file_hash for path, _, _, file_hash, _ in manifest.files(min(hosts), remote_path)}
+        report['outliers'].append(dict(fingerprint=fingerprint, hosts=sorted(hosts), **diff_files(baseline, files)))
+    return report
+
+
+# Function to build the drift report of all remote paths
+def build_report(manifest, remote_paths, cycle_id=None):
+    """
+    Build the drift report of the fleet
+    Parameters:
+    - manifest: The manifest.Manifest of the copied files
+    - remote_paths: The remote directories to compare across the VMs
+    - cycle_id: The id of the cycle the report describes
+    Returns:
+    - The report as a JSON serializable dictionary
+    """
+    report = {'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'cycle_id': cycle_id, 'paths': {}}
+    for remote_path in remote_paths:
+        path_drift = report['paths'][remote_path] = path_report(manifest, remote_path)
+        outliers = sum(len(outlier['hosts']) for outlier in path_drift['outliers'])
+        if outliers:
+            logger.warning("%s drifted on %d of %d VM(s) in %d group(s)", remote_path, outliers,
+                           path_drift['hosts'], path_drift['groups'])
+    return report
@@ -0,0 +1,175 @@
+"""
+This module caches the membership of the VM fleet and turns every discovery into a diff.
+
+Each refresh returns the VMs that were added, removed or left unchanged since the previous
+refresh, so the transfer layer can give new VMs an immediate first copy and departing VMs a
+final drain copy before their connection is torn down. Within inventory_ttl seconds of the last
+discovery the cached membership is reused without calling the cloud APIs. A failed discovery
+keeps the last known membership instead of reporting every VM as removed. Event sources (ASG
+lifecycle hooks) can add and remove single VMs between two discoveries; their changes are
+reported by the next refresh.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import threading
+import time
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+
+# Function to build an inventory diff
+def new_diff(added=None, removed=None, unchanged=None):
+    """
+    Create the diff dictionary returned by InventoryCache.refresh
+    Returns:
+    - A dictionary with the added, removed and unchanged lists of VMs
+    """
+    return {'added': added or [], 'removed': removed or [], 'unchanged': unchanged or []}
+
+
+# Function to list the VMs that should be copied for a diff
+def vms_to_copy(diff):
+    """
+    Return the VMs to copy for a diff: new VMs first, then the known ones, then one final
+    drain copy of the VMs that left (unless their final copy already happened)
+    """
+    return diff['added'] + diff['unchanged'] + [vm_info for vm_info in diff['removed'] if not vm_info.get('drained')]
+
+
+# Function to list the current members of a diff
+def current_members(diff):
+    """
+    Return the VMs that are members of the fleet after a diff
+    """
+    return diff['added'] + diff['unchanged']
+
+
+class InventoryCache:
+    """
+    Last known VM membership, refreshed at most every ttl seconds
+    Parameters:
+    - discover: A function returning the current list of VMs, or None if the discovery failed
+    - ttl: The number of seconds the membership is reused without calling discover.
+      0 discovers on every refresh.
+    """
+
+    def __init__(self, discover, ttl=0):
+        self.discover = discover
+        self.ttl = ttl
+        self._members = {}
+        self._fetched_at = None
+        self._pending_added = {}
+        self._pending_removed = {}
+        self._lock = threading.Lock()
+
+    def members(self):
+        """
+        Return the last known list of VMs
+        """
+        with self._lock:
+            return list(self._members.values())
+
+    def add(self, vm_info):
+        """
+        Add a single VM, e.g. when a lifecycle hook reports a new instance
+        """
+        with self._lock:
+            hostname = vm_info['hostname']
+            if hostname not in self._members:
+                self._pending_added[hostname] = vm_info
+            self._pending_removed.pop(hostname, None)
+            self._members[hostname] = vm_info
+
+    def remove(self, hostname, drained=False):
+        """
+        Remove a single VM, e.g. when a lifecycle hook reports a terminating instance
+        Parameters:
+        - hostname: The hostname of the VM
+        - drained: True if the final copy of the VM already happened
+        """
+        with self._lock:
+            vm_info = self._members.pop(hostname, None)
+            if vm_info is None:
+                return
+            if self._pending_added.pop(hostname, None) is None:
+                self._pending_removed[hostname] = dict(vm_info, drained=drained)
+
+    def _take_pending(self, diff):
+        # Report the changes made by add/remove since the previous refresh
+        added = {vm_info['hostname'] for vm_info in diff['added']}
+        removed = {vm_info['hostname'] for vm_info in diff['removed']}
+        diff['added'] += [vm_info for hostname, vm_info in self._pending_added.items()
+                          if hostname not in added and hostname in self._members]
+        diff['removed'] += [vm_info for hostname, vm_info in self._pending_removed.items()
+                            if hostname not in removed and hostname not in self._members]
+        added = {vm_info['hostname'] for vm_info in diff['added']}
+        diff['unchanged'] = [vm_info for vm_info in diff['unchanged'] if vm_info['hostname'] not in added]
+        self._pending_added = {}
+        self._pending_removed = {}
+        return diff
+
+    def apply(self, vm_list):
+        """
+        Replace the membership with a discovered list of VMs
+        Parameters:
+        - vm_list: The current list of VMs
+        Returns:
+        - The diff against the previous membership
+        """
+        with self._lock:
+            return self._apply(vm_list)
+
+    def _apply(self, vm_list):
+        current = {vm_info['hostname']: vm_info for vm_info in vm_list}
+        diff = new_diff(
+            added=[vm_info for hostname, vm_info in current.items() if hostname not in self._members],
+            removed=[vm_info for hostname, vm_info in self._members.items() if hostname not in current],
+            unchanged=[vm_info for hostname, vm_info in current.items() if hostname in self._members],
+        )
+        self._members = current
+        self._fetched_at = time.monotonic()
+        if diff['added'] or diff['removed']:
+            logger.info("Inventory changed: %d added, %d removed, %d unchanged",
+                        len(diff['added']), len(diff['removed']), len(diff['unchanged']))
+        return diff
+
+    def refresh(self, force=False):
+        """
+        Refresh the membership if the ttl expired and return what changed
+        Parameters:
+        - force: Discover even if the ttl did not expire yet
+        Returns:
+        - A diff dictionary (see new_diff)
+        """
+        with self._lock:
+            fresh = self._fetched_at is not None and time.monotonic() - self._fetched_at < self.ttl
+            if fresh and not force:
+                return self._take_pending(new_diff(unchanged=list(self._members.values())))
+            vm_list = self.discover()
+            if vm_list is None:
+                logger.warning("Discovery failed, keeping the last known %d VM(s)", len(self._members))
+                return self._take_pending(new_diff(unchanged=list(self._members.values())))
+            return self._take_pending(self._apply(vm_list))
@@ -0,0 +1,304 @@
+"""
+This module drives the inventory from ASG lifecycle hook notifications instead of polling.
+
+The ASG publishes a message to an SQS queue whenever an instance is launched or terminated
+(lifecycle hooks for autoscaling:EC2_INSTANCE_LAUNCHING / EC2_INSTANCE_TERMINATING with an SQS
+notification target). Launched instances are added to the inventory and get their first copy
+right away. A terminating instance is kept in Terminating:Wait with lifecycle action heartbeats
+while its final copy runs, and the lifecycle action is completed afterwards, so the logs of
+scaled-in instances are not lost.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from cc_fsync import transfer
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+LAUNCHING = 'autoscaling:EC2_INSTANCE_LAUNCHING'
+TERMINATING = 'autoscaling:EC2_INSTANCE_TERMINATING'
+TEST_NOTIFICATION = 'autoscaling:TEST_NOTIFICATION'
+# Seconds SQS long polling waits for a message
+WAIT_TIME_SECONDS = 20
+# A received message stays hidden from other receivers for this many heartbeat intervals
+VISIBILITY_FACTOR = 2
+# Seconds between two attempts of a final copy that failed
+RETRY_DELAY = 30
+# No new attempt of a final copy is started later than this many seconds before the global
+# timeout of the lifecycle hook
+DEADLINE_MARGIN = 300
+# Deliveries of a launch notification whose instance has no usable network interface yet
+MAX_LAUNCH_RECEIVES = 10
+
+
+class LifecycleConsumer:
+    """
+    Consume ASG lifecycle hook notifications from an SQS queue
+    Parameters:
+    - sqs: The boto3 sqs client
+    - autoscaling: The boto3 autoscaling client of the ASGs
+    - queue_url: The URL of the SQS queue receiving the lifecycle notifications
+    - inventory_cache: The inventory.InventoryCache to add and remove VMs from
+    - resolve_instance: A function returning the vm_info of an instance ID, or None
+    - copy_vm: A function copying the files of one VM under its host lock, called with its vm_info
+    - release_vm: A function releasing the resources of a VM that left
+    - heartbeat_interval: The number of seconds between two lifecycle action heartbeats
+    - max_workers: The number of notifications handled at the same time
+    """
+
+    def __init__(self, sqs, autoscaling, queue_url, inventory_cache, resolve_instance, copy_vm,
+                 release_vm, heartbeat_interval=60, max_workers=8):
+        self.sqs = sqs
+        self.autoscaling = autoscaling
+        self.queue_url = queue_url
+        self.inventory_cache = inventory_cache
+        self.resolve_instance = resolve_instance
+        self.copy_vm = copy_vm
+        self.release_vm = release_vm
+        self.heartbeat_interval = heartbeat_interval
+        self.visibility_timeout = heartbeat_interval * VISIBILITY_FACTOR
+        self._stop_event = threading.Event()
+        self._thread = None
+        # Messages are only received for a free worker, so none waits in the executor queue while
+        # its visibility timeout runs out
+        self._workers = threading.BoundedSemaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cc-fsync-lifecycle')
+
+    def start(self):
+        """
+        Start consuming notifications in a background thread
+        """
+        self._thread = threading.Thread(target=self._run, name='cc-fsync-lifecycle-poller', daemon=True)
+        self._thread.start()
+        logger.info("Consuming ASG lifecycle notifications from %s", self.queue_url)
+
+    def stop(self):
+        """
+        Stop consuming notifications and wait for the running ones to finish
+        """
+        self._stop_event.set()
+        # The poller may still be submitting the messages it received; let it return first
+        if self._thread:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except (BotoCoreError, ClientError) as sqs_error:
+                logger.error("Failed to receive lifecycle notifications: %s", sqs_error)
+                self._stop_event.wait(WAIT_TIME_SECONDS)
+
+    def poll(self):
+        """
+        Wait for a free worker, receive one notification and hand it to the worker
+        """
+        if not self._workers.acquire(timeout=WAIT_TIME_SECONDS):
+            return
+        try:
+            response = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=1,
+                                                WaitTimeSeconds=WAIT_TIME_SECONDS,
+                                                VisibilityTimeout=self.visibility_timeout,
+                                                AttributeNames=['ApproximateReceiveCount'])
+            messages = response.get('Messages', [])
+            if not messages or self._stop_event.is_set():
+                # A message received while stopping becomes visible again for the next daemon
+                self._workers.release()
+                return
+            self._executor.submit(self._work, messages[0])
+        except BaseException:
+            self._workers.release()
+            raise
+
+    def _work(self, message):
+        try:
+            try:
+                notification = json.loads(message['Body'])
+            except ValueError:
+                logger.warning("Ignoring malformed lifecycle notification: %s", message['Body'])
+                self.delete(message)
+                return
+            if self.handle(notification, message):
+                self.delete(message)
+        finally:
+            self._workers.release()
+
+    def handle(self, notification, message=None):
+        """
+        Handle one lifecycle notification
+        Parameters:
+        - notification: The decoded body of the SQS message
+        - message: The SQS message, whose visibility is extended while the final copy runs
+        Returns:
+        - False if the notification must be received again, e.g. because the daemon stopped during
+          the final copy, so the message must be kept; True otherwise
+        """
+        if notification.get('Event') == TEST_NOTIFICATION:
+            return True
+        transition = notification.get('LifecycleTransition')
+        instance_id = notification.get('EC2InstanceId')
+        if transition not in (LAUNCHING, TERMINATING) or not instance_id:
+            logger.debug("Ignoring lifecycle notification: %s", notification)
+            return True
+        receive_count = int((message or {}).get('Attributes', {}).get('ApproximateReceiveCount', 1))
+        handled = True
+        try:
+            if transition == LAUNCHING:
+                handled = self._launching(instance_id, receive_count)
+            else:
+                handled = self._terminating(notification, instance_id, message)
+        except Exception as handle_error:
+            logger.error("Failed to handle %s of %s: %s", transition, instance_id, handle_error)
+        if transition == LAUNCHING:
+            # A launching instance doesn't wait for its first copy; later deliveries only retry
+            # adding it to the inventory
+            if receive_count == 1:
+                self.complete(notification)
+        elif handled:
+            self.complete(notification)
+        else:
+            # The hook stays in its wait state until the restarted daemon receives the message
+            # again and runs the final copy
+            logger.info("Leaving %s of %s to the next daemon", transition, instance_id)
+        return handled
+
+    def _launching(self, instance_id, receive_count):
+        vm_info = self.resolve_instance(instance_id)
+        if vm_info is None:
+            if receive_count < MAX_LAUNCH_RECEIVES:
+                # Typically the network interface is not attached yet; SQS delivers the message again
+                logger.info("Launched instance %s has no usable network interface yet, retrying later", instance_id)
+                return False
+            logger.warning("Launched instance %s has no usable network interface", instance_id)
+            return True
+        logger.info("Instance %s (%s) launched, adding it to the inventory", instance_id, vm_info['hostname'])
+        self.inventory_cache.add(vm_info)
+        return True
+
+    def _terminating(self, notification, instance_id, message):
+        vm_info = next((member for member in self.inventory_cache.members()
+                        if member.get('instance_id') == instance_id), None) or self.resolve_instance(instance_id)
+        if vm_info is None:
+            logger.warning("Terminating instance %s is unknown, nothing to copy", instance_id)
+            return True
+        logger.info("Instance %s (%s) is terminating, running its final copy", instance_id, vm_info['hostname'])
+        deadline = self._deadline(notification)
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(notification, message, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        try:
+            while True:
+                try:
+                    results = self.copy_vm(vm_info)
+                    copied = all(transfer.succeeded(result) for result in results)
+                except Exception as copy_error:
+                    logger.error("Final copy of %s failed: %s", vm_info['hostname'], copy_error)
+                    copied = False
+                if copied:
+                    break
+                if transfer.is_cancelled() or self._stop_event.is_set():
+                    return False
+                if time.monotonic() + RETRY_DELAY > deadline:
+                    logger.error("Giving up the final copy of %s, its lifecycle hook times out soon",
+                                 vm_info['hostname'])
+                    break
+                logger.warning("Final copy of %s failed, retrying in %ss", vm_info['hostname'], RETRY_DELAY)
+                if self._stop_event.wait(RETRY_DELAY):
+                    return False
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+        self.inventory_cache.remove(vm_info['hostname'], drained=True)
+        self.release_vm(vm_info)
+        return True
+
+    def _deadline(self, notification):
+        # Heartbeats keep the hook waiting up to its global timeout, counted from the notification
+        try:
+            hooks = self.autoscaling.describe_lifecycle_hooks(
+                AutoScalingGroupName=notification['AutoScalingGroupName'],
+                LifecycleHookNames=[notification['LifecycleHookName']])['LifecycleHooks']
+            global_timeout = hooks[0]['GlobalTimeout']
+            sent = datetime.fromisoformat(notification['Time'].replace('Z', '+00:00'))
+        except (BotoCoreError, ClientError, KeyError, IndexError, ValueError) as hook_error:
+            logger.warning("Failed to get the timeout of the lifecycle hook of %s, not retrying its final copy: %s",
+                           notification.get('EC2InstanceId'), hook_error)
+            return time.monotonic()
+        elapsed = max(0, (datetime.now(sent.tzinfo) - sent).total_seconds())
+        return time.monotonic() + global_timeout - elapsed - DEADLINE_MARGIN
+
+    def _heartbeat(self, notification, message, stop_heartbeat):
+        # Keep the instance in Terminating:Wait and the message hidden while its final copy runs
+        while not stop_heartbeat.wait(self.heartbeat_interval):
+            if message:
+                try:
+                    self.sqs.change_message_visibility(QueueUrl=self.queue_url,
+                                                       ReceiptHandle=message['ReceiptHandle'],
+                                                       VisibilityTimeout=self.visibility_timeout)
+                except (BotoCoreError, ClientError) as visibility_error:
+                    logger.warning("Failed to extend the lifecycle notification of %s: %s",
+                                   notification.get('EC2InstanceId'), visibility_error)
+            try:
+                self.autoscaling.record_lifecycle_action_heartbeat(
+                    LifecycleHookName=notification['LifecycleHookName'],
+                    AutoScalingGroupName=notification['AutoScalingGroupName'],
+                    LifecycleActionToken=notification['LifecycleActionToken'],
+                    InstanceId=notification['EC2InstanceId'])
+            except (BotoCoreError, ClientError, KeyError) as heartbeat_error:
+                logger.warning("Failed to record lifecycle heartbeat for %s: %s",
+                               notification.get('EC2InstanceId'), heartbeat_error)
+
+    def complete(self, notification):
+        """
+        Complete the lifecycle action of a notification with CONTINUE
+        """
+        try:
+            self.autoscaling.complete_lifecycle_action(
+                LifecycleHookName=notification['LifecycleHookName'],
+                AutoScalingGroupName=notification['AutoScalingGroupName'],
+                LifecycleActionToken=notification['LifecycleActionToken'],
+                InstanceId=notification['EC2InstanceId'],
+                LifecycleActionResult='CONTINUE')
+        except (BotoCoreError, ClientError, KeyError) as complete_error:
+            logger.error("Failed to complete lifecycle action for %s: %s",
+                         notification.get('EC2InstanceId'), complete_error)
+
+    def delete(self, message):
+        """
+        Delete a handled message from the queue
+        """
+        try:
+            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+        except (BotoCoreError, ClientError) as delete_error:
+            logger.warning("Failed to delete lifecycle notification: %s", delete_error)
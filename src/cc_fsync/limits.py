@@ -0,0 +1,200 @@
+"""
+This module limits how many VMs of the same availability zone or subnet are copied at the same time.
+
+The per-group caps configured with the concurrency_limits setting, e.g. {"zone": 20, "subnet": 10},
+are enforced here with one semaphore per zone/subnet value, together with the global limit
+(max_concurrency). The semaphores are shared by everything copying files in the process: the
+copy cycles, including overlapping ones, the push copies and the final copies of terminating VMs.
+Discovery stores the zone and subnet of every VM in its vm_info dictionary. HostLocks makes sure
+that a VM is never copied by two of them at the same time.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import threading
+
+# The vm_info keys that can be capped with the concurrency_limits setting
+GROUP_KEYS = ('zone', 'subnet')
+# Seconds between two attempts of an asyncio task to take a slot shared with other threads
+POLL_INTERVAL = 0.2
+
+
+# Function to validate the concurrency_limits setting
+def validate_limits(limits):
+    """
+    Validate the concurrency_limits setting
+    Parameters:
+    - limits: A dictionary mapping 'zone' and/or 'subnet' to a positive integer
+    Returns:
+    - The validated dictionary
+    Raises:
+    - ValueError if a key or a value is invalid
+    """
+    limits = limits or {}
+    for key, value in limits.items():
+        if key not in GROUP_KEYS:
+            raise ValueError(f"Unsupported concurrency limit '{key}', expected one of {', '.join(GROUP_KEYS)}")
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ValueError(f"Concurrency limit '{key}' must be a positive integer")
+    return dict(limits)
+
+
+# Function to list the groups a VM belongs to
+def get_groups(vm_info, limits):
+    """
+    Return the capped groups of a VM in a fixed order, so that semaphores are always
+    acquired in the same order and can't deadlock
+    Parameters:
+    - vm_info: A dictionary containing the hostname and optionally the zone and subnet
+    - limits: The validated concurrency_limits setting
+    Returns:
+    - A list of (key, value) tuples
+    """
+    return [(key, vm_info[key]) for key in GROUP_KEYS if key in limits and vm_info.get(key)]
+
+
+# Function to interleave the VMs of different zones
+def interleave(vm_list, key='zone'):
+    """
+    Order the VMs round-robin across the values of a key, so that the workers don't all
+    wait on the semaphore of the same zone while other zones are idle
+    Parameters:
+    - vm_list: The list of VMs
+    - key: The vm_info key to interleave on
+    Returns:
+    - The reordered list of VMs
+    """
+    groups = {}
+    for vm_info in vm_list:
+        groups.setdefault(vm_info.get(key), []).append(vm_info)
+    rounds = itertools.zip_longest(*groups.values())
+    return [vm_info for vm_round in rounds for vm_info in vm_round if vm_info is not None]
+
+
+class GroupLimiter:
+    """
+    Per-zone/subnet semaphores and the global semaphore, shared by all threads and event loops
+    Parameters:
+    - limits: The validated concurrency_limits setting
+    - max_concurrency: The maximum number of VMs copied at the same time, or None for no limit
+    """
+
+    def __init__(self, limits, max_concurrency=None):
+        self.limits = limits
+        self._semaphores = {}
+        self._global = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._lock = threading.Lock()
+
+    def _semaphore(self, group):
+        with self._lock:
+            if group not in self._semaphores:
+                self._semaphores[group] = threading.BoundedSemaphore(self.limits[group[0]])
+            return self._semaphores[group]
+
+    def _vm_semaphores(self, vm_info):
+        # The zone/subnet slots first, so that waiting VMs don't hold a global slot
+        semaphores = [self._semaphore(group) for group in get_groups(vm_info, self.limits)]
+        if self._global:
+            semaphores.append(self._global)
+        return semaphores
+
+    @contextlib.contextmanager
+    def hold(self, vm_info):
+        """
+        Context manager that holds a slot in every group of a VM and a global slot
+        """
+        with contextlib.ExitStack() as stack:
+            for semaphore in self._vm_semaphores(vm_info):
+                stack.enter_context(semaphore)
+            yield
+
+    @contextlib.asynccontextmanager
+    async def hold_async(self, vm_info):
+        """
+        Async context manager that holds the same slots as hold() without blocking the event loop
+        """
+        async with contextlib.AsyncExitStack() as stack:
+            for semaphore in self._vm_semaphores(vm_info):
+                await stack.enter_async_context(acquire_async(semaphore))
+            yield
+
+
+class AsyncGroupLimiter:
+    """
+    Per-zone/subnet semaphores for the asyncio concurrency model
+    Parameters:
+    - limits: The validated concurrency_limits setting
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._semaphores = {}
+
+    def _semaphore(self, group):
+        if group not in self._semaphores:
+            self._semaphores[group] = asyncio.Semaphore(self.limits[group[0]])
+        return self._semaphores[group]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, vm_info):
+        """
+        Async context manager that holds a slot in every group of a VM
+        """
+        async with contextlib.AsyncExitStack() as stack:
+            for group in get_groups(vm_info, self.limits):
+                await stack.enter_async_context(self._semaphore(group))
+            yield
+
+
+@contextlib.asynccontextmanager
+async def acquire_async(lock):
+    """
+    Async context manager holding a threading lock or semaphore that is shared with other threads
+    """
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+class HostLocks:
+    """
+    One lock per VM hostname, so that a VM is never copied by two transfers at the same time,
+    e.g. by a copy cycle and by a push copy, which would both write the same local files
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, hostname):
+        """
+        Return the lock of a VM
+        """
+        with self._lock:
+            return self._locks.setdefault(hostname, threading.Lock())
@@ -0,0 +1,266 @@
+"""
+This module keeps an index of every copied file in a SQLite database and lets you query it.
+
+After every successful transfer, the files below the copied paths are recorded with their host,
+remote path, size, mtime, SHA-256 and the id of the cycle that last changed them. Only files
+whose size or mtime changed since the previous transfer are hashed again. The database runs in
+WAL mode, so the CLI can query it while the daemon writes:
+
+    python -m cc_fsync manifest hosts
+    python -m cc_fsync manifest files 10.0.1.15 /etc/janus
+    python -m cc_fsync manifest compare /etc/janus
+    python -m cc_fsync manifest drift /etc/janus /etc/nimbus
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import stat
+import sys
+import threading
+import time
+
+from cc_fsync import drift
+from cc_fsync.cas import hash_file
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cycles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    host TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    cycle_id INTEGER,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (host, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_by_path ON files (path, hash);
+"""
+# Milliseconds a connection waits for the write lock of another process
+BUSY_TIMEOUT = 30000
+
+
+# Function to get the bounds of the paths below a directory
+def path_range(remote_path):
+    """
+    Return the (low, high) bounds of the paths strictly below a remote directory. '0' is the
+    character following '/', so the range can be answered from the index.
+    """
+    prefix = remote_path.rstrip('/')
+    return f"{prefix}/", f"{prefix}0"
+
+
+class Manifest:
+    """
+    SQLite index of the copied files of all VMs
+    Parameters:
+    - path: The path of the database file. Missing parent directories are created.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        """
+        Return the connection of the calling thread, opening it on first use
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT / 1000)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+            self._local.connection = connection
+        return connection
+
+    def new_cycle(self):
+        """
+        Record the start of a copy cycle and return its id
+        """
+        with self._write_lock, self.connection() as connection:
+            return connection.execute('INSERT INTO cycles (started_at) VALUES (?)', (time.time(),)).lastrowid
+
+    def update(self, host, host_dir, remote_path, cycle_id=None):
+        """
+        Record the current files of the local copy of a remote path
+        Parameters:
+        - host: The hostname of the VM
+        - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+        - remote_path: The remote path that was copied
+        - cycle_id: The id of the current cycle, recorded for new and changed files
+        Returns:
+        - The list of remote files that are new or changed
+        """
+        low, high = path_range(remote_path)
+        known = {row[0]: (row[1], row[2]) for row in self.connection().execute(
+            'SELECT path, size, mtime FROM files WHERE host = ? AND path >= ? AND path < ?', (host, low, high))}
+        local_root = os.path.join(host_dir, remote_path.strip('/'))
+        changed = []
+        seen = set()
+        for root, _, names in os.walk(local_root):
+            for name in names:
+                local_path = os.path.join(root, name)
+                remote_file = '/' + os.path.relpath(local_path, host_dir).replace(os.sep, '/')
+                try:
+                    file_stat = os.lstat(local_path)
+                    if not stat.S_ISREG(file_stat.st_mode):
+                        continue
+                    seen.add(remote_file)
+                    if known.get(remote_file) == (file_stat.st_size, int(file_stat.st_mtime)):
+                        continue
+                    # Hashing runs outside of the write lock
+                    changed.append((host, remote_file, file_stat.st_size, int(file_stat.st_mtime),
+                                    hash_file(local_path), cycle_id, time.time()))
+                except OSError as stat_error:
+                    logger.debug("Failed to index %s: %s", local_path, stat_error)
+        removed = [(host, remote_file) for remote_file in known if remote_file not in seen]
+        if changed or removed:
+            with self._write_lock, self.connection() as connection:
+                connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', changed)
+                connection.executemany('DELETE FROM files WHERE host = ? AND path = ?', removed)
+        return [row[1] for row in changed]
+
+    def remove_host(self, host):
+        """
+        Forget the files of a VM that left
+        """
+        with self._write_lock, self.connection() as connection:
+            connection.execute('DELETE FROM files WHERE host = ?', (host,))
+
+    def hosts(self):
+        """
+        Return (host, number of files, total size, last cycle id) for every VM
+        """
+        return self.connection().execute(
+            'SELECT host, COUNT(*), SUM(size), MAX(cycle_id) FROM files GROUP BY host ORDER BY host').fetchall()
+
+    def files(self, host, remote_path='/'):
+        """
+        Return (path, size, mtime, hash, cycle_id) for the files of a VM below a remote path
+        """
+        low, high = path_range(remote_path)
+        return self.connection().execute(
+            'SELECT path, size, mtime, hash, cycle_id FROM files WHERE host = ? AND path >= ? AND path < ? '
+            'ORDER BY path', (host, low, high)).fetchall()
+
+    def fingerprints(self, remote_path):
+        """
+        Compute a fingerprint of the content below a remote path for every VM
+        Parameters:
+        - remote_path: The remote directory, e.g. /etc/janus
+        Returns:
+        - A dictionary mapping every host to the SHA-256 of its sorted (path, hash) list
+        """
+        low, high = path_range(remote_path)
+        digests = {}
+        for host, path, file_hash in self.connection().execute(
+                'SELECT host, path, hash FROM files WHERE path >= ? AND path < ? ORDER BY host, path', (low, high)):
+            digests.setdefault(host, hashlib.sha256()).update(f"{path}\0{file_hash}\n".encode(errors='surrogateescape'))
+        return {host: digest.hexdigest() for host, digest in digests.items()}
+
+    def compare(self, remote_path):
+        """
+        Group the VMs by the content below a remote path
+        Returns:
+        - A list of (fingerprint, hosts) tuples, the largest group first
+        """
+        groups = {}
+        for host, fingerprint in self.fingerprints(remote_path).items():
+            groups.setdefault(fingerprint, []).append(host)
+        return sorted(groups.items(), key=lambda group: (-len(group[1]), group[0]))
+
+
+# Function to get the default database path from the settings file
+def default_database(settings_file):
+    """
+    Return <state_dir>/manifest.db, or the manifest_db setting, of a settings file
+    """
+    try:
+        with open(settings_file, encoding="utf-8") as f_stream:
+            settings = json.load(f_stream)
+    except (OSError, ValueError):
+        settings = {}
+    return settings.get('manifest_db') or os.path.join(settings.get('state_dir', './.cc-fsync'), 'manifest.db')
+
+
+# Function to run the manifest subcommand
+def main(argv=None):
+    """
+    Query the manifest database from the command line
+    Parameters:
+    - argv: The arguments following 'manifest'
+    Returns:
+    - The exit code
+    """
+    parser = argparse.ArgumentParser(prog='cc_fsync manifest', description="Query the index of the copied files.")
+    parser.add_argument('--settings', default='./settings.json', help="Settings file locating the database")
+    parser.add_argument('--db', help="Path of the manifest database")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('hosts', help="List the VMs with their number of files and total size")
+    files_parser = commands.add_parser('files', help="List the files of a VM")
+    files_parser.add_argument('host')
+    files_parser.add_argument('path', nargs='?', default='/')
+    compare_parser = commands.add_parser('compare', help="Group the VMs by the content of a remote path")
+    compare_parser.add_argument('path')
+    drift_parser = commands.add_parser('drift', help="Report the VMs whose files differ from the majority")
+    drift_parser.add_argument('paths', nargs='+')
+    args = parser.parse_args(argv)
+
+    database = args.db or default_database(args.settings)
+    if not os.path.exists(database):
+        print(f"No manifest database at {database}", file=sys.stderr)
+        return 1
+    manifest = Manifest(database)
+    if args.command == 'hosts':
+        for host, count, size, cycle_id in manifest.hosts():
+            print(f"{host}\t{count} files\t{size} bytes\tcycle {cycle_id}")
+    elif args.command == 'files':
+        for path, size, mtime, file_hash, cycle_id in manifest.files(args.host, args.path):
+            print(f"{path}\t{size}\t{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(mtime))}\t{file_hash}"
+                  f"\tcycle {cycle_id}")
+    elif args.command == 'drift':
+        print(json.dumps(drift.build_report(manifest, args.paths), indent=2))
+    else:
+        groups = manifest.compare(args.path)
+        if not groups:
+            print(f"No files below {args.path}", file=sys.stderr)
+            return 1
+        for fingerprint, hosts in groups:
+            print(f"{fingerprint[:12]}\t{len(hosts)} host(s)\t{' '.join(sorted(hosts))}")
+    return 0
@@ -0,0 +1,154 @@
+"""
+This module turns the rsync tuning profiles of the settings into rsync options.
+
+A profile is a small dictionary, e.g. {"compress": "zstd", "compress_level": 3, "append_verify": true}.
+The transfer_profiles setting names the profiles and path_profiles maps remote paths to a profile
+name; remote paths without a mapping use the "default" profile, which is plain rsync -az unless it
+is overridden. Every profile is validated and converted into its rsync options once, when the
+settings are loaded.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+# Name of the profile used by remote paths without an entry in path_profiles
+DEFAULT_PROFILE = 'default'
+# Compression algorithms accepted by rsync --compress-choice (rsync 3.2 or later)
+COMPRESS_CHOICES = ('zstd', 'lz4', 'zlibx', 'zlib', 'none')
+# Settings of a profile that are simple on/off rsync flags
+FLAG_OPTIONS = {
+    'whole_file': '--whole-file',
+    'inplace': '--inplace',
+    'append_verify': '--append-verify',
+    'checksum': '--checksum',
+}
+PROFILE_KEYS = ('compress', 'compress_level', 'bwlimit', 'include', 'exclude') + tuple(FLAG_OPTIONS)
+# rsync options the tar seed of a new VM can't honor
+UNSEEDABLE_OPTIONS = ('--bwlimit=', '--include=', '--exclude=')
+
+
+# Function to convert one profile into rsync options
+def build_rsync_options(name, profile):
+    """
+    Validate a profile and convert it into rsync options
+    Parameters:
+    - name: The name of the profile, used in error messages
+    - profile: The profile dictionary
+    Returns:
+    - The rsync options as a list of arguments, without -a and --stats
+    Raises:
+    - ValueError if a key or a value is invalid
+    """
+    if not isinstance(profile, dict):
+        raise ValueError(f"Profile '{name}' must be an object")
+    for key in profile:
+        if key not in PROFILE_KEYS:
+            raise ValueError(f"Unsupported option '{key}' in profile '{name}', expected one of {', '.join(PROFILE_KEYS)}")
+    options = []
+    # compress: true/false, or the name of the algorithm
+    compress = profile.get('compress', True)
+    if isinstance(compress, str):
+        if compress not in COMPRESS_CHOICES:
+            raise ValueError(f"Profile '{name}': compress must be true, false or one of {', '.join(COMPRESS_CHOICES)}")
+        if compress != 'none':
+            options += ['-z', f"--compress-choice={compress}"]
+    elif not isinstance(compress, bool):
+        raise ValueError(f"Profile '{name}': compress must be true, false or one of {', '.join(COMPRESS_CHOICES)}")
+    elif compress:
+        options.append('-z')
+    if 'compress_level' in profile:
+        level = profile['compress_level']
+        if not isinstance(level, int) or isinstance(level, bool) or not options:
+            raise ValueError(f"Profile '{name}': compress_level must be an integer and needs compress")
+        options.append(f"--compress-level={level}")
+    for key, flag in FLAG_OPTIONS.items():
+        value = profile.get(key, False)
+        if not isinstance(value, bool):
+            raise ValueError(f"Profile '{name}': {key} must be true or false")
+        if value:
+            options.append(flag)
+    if 'bwlimit' in profile:
+        bwlimit = profile['bwlimit']
+        if isinstance(bwlimit, bool) or not isinstance(bwlimit, (int, str)) or not str(bwlimit):
+            raise ValueError(f"Profile '{name}': bwlimit must be a rate such as 5000 or \"20m\"")
+        options.append(f"--bwlimit={bwlimit}")
+    # Includes first, rsync uses the first matching filter rule
+    for key in ('include', 'exclude'):
+        patterns = profile.get(key, [])
+        if not isinstance(patterns, list) or not all(isinstance(pattern, str) for pattern in patterns):
+            raise ValueError(f"Profile '{name}': {key} must be a list of patterns")
+        options += [f"--{key}={pattern}" for pattern in patterns]
+    return options
+
+
+# Function to validate the transfer_profiles and path_profiles settings
+def validate_profiles(profiles, path_profiles):
+    """
+    Validate the profiles and the mapping of remote paths to profiles
+    Parameters:
+    - profiles: The transfer_profiles setting, mapping a profile name to a profile dictionary
+    - path_profiles: The path_profiles setting, mapping a remote path to a profile name
+    Returns:
+    - A dictionary mapping every profile name to its rsync options, and the path mapping
+      with normalized remote paths
+    Raises:
+    - ValueError if a profile or the mapping is invalid
+    """
+    profiles = dict(profiles or {})
+    profiles.setdefault(DEFAULT_PROFILE, {})
+    options = {name: build_rsync_options(name, profile) for name, profile in profiles.items()}
+    mapping = {}
+    for remote_path, name in (path_profiles or {}).items():
+        if name not in options:
+            raise ValueError(f"Remote path '{remote_path}' uses the unknown profile '{name}'")
+        mapping[normalize_path(remote_path)] = name
+    return options, mapping
+
+
+# Function to normalize a remote path for the profile lookup
+def normalize_path(remote_path):
+    """
+    Return a remote path without trailing slashes, e.g. /etc/janus/ becomes /etc/janus
+    """
+    return remote_path.rstrip('/') or '/'
+
+
+# Function to get the profile of a remote path
+def profile_for(remote_path, path_profiles):
+    """
+    Return the name of the profile used for a remote path
+    Parameters:
+    - remote_path: The remote path
+    - path_profiles: The normalized path mapping returned by validate_profiles
+    """
+    return path_profiles.get(normalize_path(remote_path), DEFAULT_PROFILE)
+
+
+# Function to check if the paths of a profile can be seeded
+def can_seed(options):
+    """
+    Return True if the first copy of the paths using a profile may be a tar archive, i.e. if the
+    profile neither filters the files nor limits the bandwidth
+    Parameters:
+    - options: The rsync options of the profile, as returned by build_rsync_options
+    """
+    return not any(option.startswith(UNSEEDABLE_OPTIONS) for option in options)
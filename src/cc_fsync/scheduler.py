@@ -0,0 +1,177 @@
+"""
+This module schedules every VM independently instead of copying all VMs in lockstep cycles.
+
+A priority queue holds the next due time of every VM. When the copy of a VM finishes, the VM
+is put back into the queue one interval later, plus or minus a random jitter, so the SSH
+load spreads evenly over the interval instead of spiking at the top of every tick. The VMs
+found at startup get a random first due time within the first interval for the same reason.
+The inventory is refreshed once per interval in the background: VMs that join later are
+copied right away, VMs that leave get one final drain copy and are then forgotten.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+
+class VMScheduler:
+    """
+    Per-VM scheduler driven by a priority queue of (next_due_time, hostname)
+    Parameters:
+    - discover: A function returning an inventory diff (see inventory.new_diff)
+    - copy_vm: A function copying the files of one VM, called with its vm_info
+    - interval: The number of seconds between two copies of the same VM
+    - max_concurrency: The maximum number of VMs copied at the same time
+    - jitter: The random jitter added to every due time, as a fraction of the interval
+    - on_removed: An optional function called with the vm_info of a departed VM after its final copy
+    """
+
+    def __init__(self, discover, copy_vm, interval, max_concurrency, jitter=0.1, on_removed=None):
+        self.discover = discover
+        self.copy_vm = copy_vm
+        self.on_removed = on_removed
+        self.interval = interval
+        self.jitter = jitter
+        self._queue = []
+        # Current due time per hostname; queue entries with another due time are stale
+        self._due = {}
+        self._sequence = itertools.count()
+        self._vms = {}
+        self._draining = {}
+        self._started = False
+        self._in_flight = set()
+        self._next_discovery = 0
+        self._discovery = None
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='cc-fsync-vm')
+        self._discovery_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cc-fsync-discovery')
+
+    def _push(self, hostname, due):
+        self._due[hostname] = due
+        heapq.heappush(self._queue, (due, next(self._sequence), hostname))
+
+    def _next_due(self, now):
+        return now + self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def update_vms(self, diff):
+        """
+        Apply an inventory diff: schedule new VMs and drain the ones that left
+        Parameters:
+        - diff: The added, removed and unchanged VMs (see inventory.new_diff)
+        """
+        now = time.monotonic()
+        with self._lock:
+            for vm_info in diff['unchanged']:
+                self._vms[vm_info['hostname']] = vm_info
+            for vm_info in diff['added']:
+                hostname = vm_info['hostname']
+                self._vms[hostname] = vm_info
+                self._draining.pop(hostname, None)
+                # Spread the VMs found at startup over the interval, copy later arrivals right away
+                self._push(hostname, now + random.uniform(0, self.interval) if not self._started else now)
+            drained = []
+            for vm_info in diff['removed']:
+                hostname = vm_info['hostname']
+                self._vms.pop(hostname, None)
+                self._due.pop(hostname, None)
+                if vm_info.get('drained'):
+                    drained.append(vm_info)
+                    continue
+                # One final copy before the VM is forgotten
+                self._draining[hostname] = vm_info
+                self._push(hostname, now)
+            self._started = True
+        if self.on_removed:
+            for vm_info in drained:
+                self.on_removed(vm_info)
+        if diff['added'] or diff['removed']:
+            logger.info("VM list changed: %d added, %d removed, %d scheduled",
+                        len(diff['added']), len(diff['removed']), len(self._vms))
+
+    def _poll_discovery(self, now):
+        if self._discovery and self._discovery.done():
+            try:
+                diff = self._discovery.result()
+            except Exception as discovery_error:
+                logger.error("Failed to discover VMs: %s", discovery_error)
+                diff = None
+            self._discovery = None
+            # Keep the current VMs if the discovery failed
+            if diff:
+                self.update_vms(diff)
+        if self._discovery is None and now >= self._next_discovery:
+            self._next_discovery = now + self.interval
+            self._discovery = self._discovery_executor.submit(self.discover)
+
+    def run_pending(self):
+        """
+        Start the copies of all due VMs; called from the main loop about once a second
+        """
+        if self._stopped:
+            return
+        now = time.monotonic()
+        self._poll_discovery(now)
+        with self._lock:
+            while self._queue and self._queue[0][0] <= now:
+                due, _, hostname = heapq.heappop(self._queue)
+                vm_info = self._vms.get(hostname) or self._draining.get(hostname)
+                # Skip stale entries, VMs that left the VM list and VMs still being copied
+                if vm_info is None or self._due.get(hostname) != due or hostname in self._in_flight:
+                    continue
+                del self._due[hostname]
+                self._in_flight.add(hostname)
+                self._executor.submit(self._copy, vm_info)
+
+    def _copy(self, vm_info):
+        hostname = vm_info['hostname']
+        try:
+            self.copy_vm(vm_info)
+        except Exception as copy_error:
+            logger.error("Failed to copy files from %s: %s", hostname, copy_error)
+        finally:
+            with self._lock:
+                self._in_flight.discard(hostname)
+                drained = self._draining.pop(hostname, None)
+                if hostname in self._vms and not self._stopped:
+                    # Reschedule relative to the end of the copy, so a slow VM never overlaps itself
+                    self._push(hostname, self._next_due(time.monotonic()))
+            if drained and self.on_removed:
+                self.on_removed(drained)
+
+    def stop(self):
+        """
+        Stop scheduling and wait for the running copies to finish
+        """
+        self._stopped = True
+        self._discovery_executor.shutdown(wait=False)
+        self._executor.shutdown(wait=True, cancel_futures=True)
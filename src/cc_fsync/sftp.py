@@ -0,0 +1,296 @@
+"""
+This module copies files from the CC VMs over SFTP with paramiko, without forking rsync or ssh.
+
+It is an alternative transfer backend for hosts without rsync. A transfer backend turns a VM into
+a list of planned transfers (see sync.plan_transfers); the plans of this backend carry a run
+function instead of a command line, which transfer.run_plan calls in the worker thread. One SSH
+connection per VM is kept open across paths and cycles. Remote files are read with pipelined
+(prefetched) requests over a large channel window and are only downloaded when their size or
+mtime differ from the local copy. Like the rsync transfers, files are never deleted locally.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import os
+import posixpath
+import socket
+import stat
+import threading
+import time
+
+import paramiko
+
+from cc_fsync import transfer
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# SSH channel window of the SFTP session; a large window keeps many prefetched reads in flight
+WINDOW_SIZE = 16 * 1024 * 1024
+MAX_PACKET_SIZE = 32 * 1024
+# Seconds to wait for the SSH connection and banner
+CONNECT_TIMEOUT = 30
+# Number of skipped files listed in the error of a partial transfer
+MAX_LISTED_FILES = 10
+
+
+class TransferAborted(Exception):
+    """
+    Raised from the download callback when the deadline passed or the daemon is shutting down
+    """
+
+
+class SFTPBackend:
+    """
+    SFTP transfer backend keeping one paramiko connection per VM hostname
+    Parameters:
+    - server_command: The command starting the SFTP server on the VM, e.g. with sudo, so that
+      files only readable by root can be copied. None uses the sftp subsystem of sshd.
+    - port: The SSH port of the VMs
+    """
+
+    def __init__(self, server_command=None, port=22):
+        self.server_command = server_command
+        self.port = port
+        self._connections = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def _host_lock(self, hostname):
+        with self._lock:
+            return self._host_locks.setdefault(hostname, threading.Lock())
+
+    def _connect(self, vm_info):
+        client = paramiko.SSHClient()
+        # Same trust model as the rsync transfers (StrictHostKeyChecking=no)
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(vm_info['hostname'], port=vm_info.get('port', self.port), username=vm_info['username'],
+                       key_filename=vm_info['key_filename'], timeout=CONNECT_TIMEOUT,
+                       banner_timeout=CONNECT_TIMEOUT, allow_agent=False, look_for_keys=False)
+        transport = client.get_transport()
+        transport.set_keepalive(30)
+        channel = transport.open_session(window_size=WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE)
+        if self.server_command:
+            channel.exec_command(self.server_command)
+        else:
+            channel.invoke_subsystem('sftp')
+        return client, paramiko.SFTPClient(channel)
+
+    def sftp_client(self, vm_info):
+        """
+        Return the SFTP client of a VM, connecting if there is no live connection yet
+        """
+        hostname = vm_info['hostname']
+        with self._lock:
+            connection = self._connections.get(hostname)
+        if connection and connection[0].get_transport() and connection[0].get_transport().is_active():
+            return connection[1]
+        if connection:
+            self.close(hostname)
+        client, sftp = self._connect(vm_info)
+        with self._lock:
+            self._connections[hostname] = (client, sftp)
+        return sftp
+
+    def plan_transfers(self, vm_info, host_dir):
+        """
+        Build one planned transfer per remote path of a VM
+        Parameters:
+        - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+        - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+        Returns:
+        - A list of dictionaries with the remote_paths, a descriptive command and the run function
+        """
+        plans = []
+        for remote_path in vm_info['remote_paths']:
+            local_path = os.path.join(host_dir, remote_path.lstrip('/'))
+            plans.append({
+                'remote_paths': [remote_path],
+                'command': ['sftp', f"{vm_info['username']}@{vm_info['hostname']}:{remote_path}/"],
+                'run': lambda timeout, remote_path=remote_path, local_path=local_path:
+                    self.copy_path(vm_info, remote_path, local_path, timeout),
+            })
+        return plans
+
+    def copy_path(self, vm_info, remote_path, local_path, timeout=None):
+        """
+        Copy a remote directory (or file) of a VM, skipping files whose size and mtime did not change
+        Parameters:
+        - vm_info: A dictionary containing the hostname, username and key_filename
+        - remote_path: The remote directory to copy
+        - local_path: The local directory to copy the files to
+        - timeout: The maximum number of seconds the transfer may run, or None for no limit
+        Returns:
+        - A result dictionary (see transfer.new_result)
+        """
+        hostname = vm_info['hostname']
+        result = transfer.new_result(['sftp', f"{vm_info['username']}@{hostname}:{remote_path}/"])
+        if transfer.is_cancelled():
+            result['cancelled'] = True
+            return result
+        start = time.monotonic()
+        deadline = start + timeout if timeout else None
+        # paramiko channels are not meant to be shared by concurrent transfers
+        with self._host_lock(hostname):
+            try:
+                sftp = self.sftp_client(vm_info)
+                # The connection is reused, so the timeout of the previous transfer is always replaced
+                self._bound_requests(sftp, deadline)
+                attributes = sftp.stat(remote_path)
+                # Files below the remote path that could not be read; the others are still copied
+                unreadable = []
+                if stat.S_ISDIR(attributes.st_mode):
+                    result['bytes_transferred'] = self._copy_tree(sftp, remote_path, local_path, deadline,
+                                                                  unreadable)
+                else:
+                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                    result['bytes_transferred'] = self._copy_file(sftp, remote_path, local_path,
+                                                                  attributes, deadline)
+                if unreadable:
+                    # Like rsync's partial transfer, the path is copied again by the next cycle
+                    result['exit_code'] = 1
+                    result['error'] = (f"Partial transfer, skipped {len(unreadable)} unreadable file(s): "
+                                       f"{', '.join(unreadable[:MAX_LISTED_FILES])}")
+                else:
+                    result['exit_code'] = 0
+            except TransferAborted:
+                result['exit_code'] = 1
+                result['cancelled'] = transfer.is_cancelled()
+                result['timed_out'] = not result['cancelled']
+                # The connection may be in the middle of a read; start from scratch next time
+                self.close(hostname)
+            except socket.timeout:
+                result['exit_code'] = 1
+                result['timed_out'] = True
+                self.close(hostname)
+            except (OSError, EOFError, paramiko.SSHException) as sftp_error:
+                result['exit_code'] = 1
+                result['error'] = str(sftp_error) or type(sftp_error).__name__
+                self.close(hostname)
+        result['duration'] = time.monotonic() - start
+        return result
+
+    def _bound_requests(self, sftp, deadline):
+        # Without a channel timeout a VM that stops answering blocks stat, listdir and reads forever
+        sftp.get_channel().settimeout(max(deadline - time.monotonic(), 1) if deadline else None)
+
+    def _copy_tree(self, sftp, remote_dir, local_dir, deadline, unreadable):
+        copied = 0
+        os.makedirs(local_dir, exist_ok=True)
+        self._bound_requests(sftp, deadline)
+        for attributes in sftp.listdir_attr(remote_dir):
+            remote_path = posixpath.join(remote_dir, attributes.filename)
+            local_path = os.path.join(local_dir, attributes.filename)
+            # A file that is rotated away or not readable without a server_command must not stop
+            # the rest of the directory; the request failed cleanly, so the connection is kept
+            try:
+                if stat.S_ISDIR(attributes.st_mode):
+                    copied += self._copy_tree(sftp, remote_path, local_path, deadline, unreadable)
+                elif stat.S_ISLNK(attributes.st_mode):
+                    self._copy_link(sftp, remote_path, local_path)
+                elif stat.S_ISREG(attributes.st_mode):
+                    copied += self._copy_file(sftp, remote_path, local_path, attributes, deadline)
+            except FileNotFoundError:
+                logger.info("Skipping %s, it vanished during the transfer", remote_path)
+            except PermissionError as permission_error:
+                logger.warning("Skipping %s: %s", remote_path, permission_error)
+                unreadable.append(remote_path)
+        return copied
+
+    def _copy_link(self, sftp, remote_path, local_path):
+        target = sftp.readlink(remote_path)
+        if os.path.islink(local_path) and os.readlink(local_path) == target:
+            return
+        if os.path.lexists(local_path):
+            os.remove(local_path)
+        os.symlink(target, local_path)
+
+    def _copy_file(self, sftp, remote_path, local_path, attributes, deadline):
+        try:
+            local = os.stat(local_path)
+            if local.st_size == attributes.st_size and int(local.st_mtime) == attributes.st_mtime:
+                return 0
+        except FileNotFoundError:
+            pass
+
+        def check_deadline(transferred, total):
+            if transfer.is_cancelled() or (deadline and time.monotonic() > deadline):
+                raise TransferAborted()
+
+        check_deadline(0, attributes.st_size)
+        # Download next to the target and rename, so a partial file never replaces a good copy
+        tmp_path = os.path.join(os.path.dirname(local_path), f".{os.path.basename(local_path)}.cc-fsync")
+        try:
+            self._bound_requests(sftp, deadline)
+            with open(tmp_path, 'wb') as f_stream:
+                # prefetch pipelines the read requests instead of waiting for every block
+                sftp.getfo(remote_path, f_stream, callback=check_deadline, prefetch=True)
+            os.chmod(tmp_path, stat.S_IMODE(attributes.st_mode))
+            os.utime(tmp_path, (attributes.st_atime, attributes.st_mtime))
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return attributes.st_size
+
+    def hostnames(self):
+        """
+        Return the hostnames that currently have a connection
+        """
+        with self._lock:
+            return set(self._connections)
+
+    def close(self, hostname):
+        """
+        Close the connection of a VM
+        """
+        with self._lock:
+            connection = self._connections.pop(hostname, None)
+        if connection:
+            logger.info("Closing SFTP connection to %s", hostname)
+            connection[0].close()
+
+    def prune(self, vm_list, host_locks=None):
+        """
+        Close the connections of VMs that are no longer in the VM list
+        Parameters:
+        - vm_list: The current list of VMs
+        - host_locks: Optional limits.HostLocks; every connection is then closed under the lock of
+          its VM, so that a copy still running on it is not cut off
+        """
+        active = {vm_info['hostname'] for vm_info in vm_list}
+        for hostname in self.hostnames() - active:
+            if host_locks:
+                with host_locks.get(hostname):
+                    self.close(hostname)
+            else:
+                self.close(hostname)
+
+    def close_all(self):
+        """
+        Close every connection of the backend
+        """
+        for hostname in self.hostnames():
+            self.close(hostname)
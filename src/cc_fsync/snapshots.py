@@ -0,0 +1,177 @@
+"""
+This module keeps point-in-time snapshots of the local copy of every VM.
+
+After the transfers of a VM changed something, its local directory is copied into a new snapshot
+directory with 'rsync -a --link-dest=<previous snapshot>': files that did not change since the
+previous snapshot become hardlinks to it, so a snapshot only costs the directory entries and the
+changed files. A snapshot is written to <name>.partial and renamed when it is complete, so an
+interrupted snapshot is never used as --link-dest. Snapshots are thinned by a retention policy
+that keeps the last N snapshots plus the newest snapshot of each of the last hours and days.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import os
+import shutil
+import time
+
+from cc_fsync import transfer
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Snapshot names are UTC timestamps, so they sort chronologically
+NAME_FORMAT = '%Y%m%dT%H%M%SZ'
+PARTIAL_SUFFIX = '.partial'
+# Settings of the retention policy and their defaults
+RETENTION_DEFAULTS = {'keep_last': 60, 'hourly': 24, 'daily': 30}
+
+
+# Function to validate the snapshots setting
+def validate_retention(retention):
+    """
+    Validate the snapshots setting
+    Parameters:
+    - retention: A dictionary with the keep_last, hourly and daily counts
+    Returns:
+    - The retention with the defaults filled in
+    Raises:
+    - ValueError if a key or a value is invalid
+    """
+    retention = dict(retention or {})
+    for key, value in retention.items():
+        if key not in RETENTION_DEFAULTS:
+            raise ValueError(f"Unsupported snapshot setting '{key}', expected one of {', '.join(RETENTION_DEFAULTS)}")
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError(f"Snapshot setting '{key}' must be a non-negative integer")
+    if retention.get('keep_last') == 0:
+        raise ValueError("Snapshot setting 'keep_last' must keep at least the latest snapshot")
+    return dict(RETENTION_DEFAULTS, **retention)
+
+
+# Function to select the snapshots removed by the retention policy
+def select_expired(names, keep_last, hourly, daily):
+    """
+    Return the snapshots that are not kept by the retention policy
+    Parameters:
+    - names: The names of the complete snapshots
+    - keep_last: The number of most recent snapshots that are always kept
+    - hourly: The number of hours whose newest snapshot is kept
+    - daily: The number of days whose newest snapshot is kept
+    Returns:
+    - The list of expired snapshot names
+    """
+    names = sorted(names, reverse=True)
+    kept = set(names[:keep_last])
+    # Names start with YYYYmmddTHH, so a prefix identifies the hour or the day
+    for prefix_length, count in ((11, hourly), (8, daily)):
+        periods = set()
+        for name in names:
+            period = name[:prefix_length]
+            if period in periods:
+                continue
+            if len(periods) >= count:
+                break
+            periods.add(period)
+            kept.add(name)
+    return [name for name in names if name not in kept]
+
+
+class SnapshotStore:
+    """
+    Hardlinked point-in-time snapshots of the local directories of the VMs
+    Parameters:
+    - directory: The directory holding one snapshot directory per VM. It must be on the same file
+      system as base_local_dir and outside of the VM directories.
+    - retention: The validated snapshots setting (see validate_retention)
+    """
+
+    def __init__(self, directory, retention):
+        self.directory = directory
+        self.retention = retention
+
+    def host_directory(self, hostname):
+        """
+        Return the directory holding the snapshots of a VM
+        """
+        return os.path.join(self.directory, hostname)
+
+    def snapshots(self, hostname):
+        """
+        Return the names of the complete snapshots of a VM, oldest first
+        """
+        try:
+            names = os.listdir(self.host_directory(hostname))
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if not name.endswith(PARTIAL_SUFFIX))
+
+    def plan_snapshot(self, hostname, host_dir):
+        """
+        Build the transfer creating a new snapshot of the local directory of a VM
+        Parameters:
+        - hostname: The hostname of the VM
+        - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+        Returns:
+        - A planned local transfer (see transfer.run_plan) with an on_success function completing the
+          snapshot. It only runs after every other transfer of the VM succeeded.
+        """
+        host_snapshots = self.host_directory(hostname)
+        os.makedirs(host_snapshots, exist_ok=True)
+        name = time.strftime(NAME_FORMAT, time.gmtime())
+        partial = os.path.join(host_snapshots, name + PARTIAL_SUFFIX)
+        command = ['rsync', '-a']
+        previous = self.snapshots(hostname)
+        if previous:
+            # A relative --link-dest is resolved against the destination directory
+            command.append(f"--link-dest=../{previous[-1]}")
+        command += [f"{host_dir}/", f"{partial}/"]
+        return {
+            'remote_paths': [f"snapshot {name}"],
+            'command': command,
+            # Nothing is received from the VM, so no bytes are counted
+            'run': lambda timeout: transfer.run_command(command, timeout=timeout, parse_output=None),
+            'local': True,
+            'on_success': lambda: self.complete(hostname, name),
+        }
+
+    def complete(self, hostname, name):
+        """
+        Mark a snapshot as complete and apply the retention policy
+        """
+        host_snapshots = self.host_directory(hostname)
+        os.replace(os.path.join(host_snapshots, name + PARTIAL_SUFFIX), os.path.join(host_snapshots, name))
+        self.prune(hostname)
+
+    def prune(self, hostname):
+        """
+        Remove the expired and interrupted snapshots of a VM
+        """
+        host_snapshots = self.host_directory(hostname)
+        expired = select_expired(self.snapshots(hostname), **self.retention)
+        partial = [name for name in os.listdir(host_snapshots) if name.endswith(PARTIAL_SUFFIX)]
+        for name in expired + partial:
+            shutil.rmtree(os.path.join(host_snapshots, name), ignore_errors=True)
+        if expired:
+            logger.debug("Removed %d expired snapshot(s) of %s", len(expired), hostname)
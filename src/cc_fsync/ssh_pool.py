@@ -0,0 +1,136 @@
+"""
+This module keeps one persistent SSH connection per CC VM using OpenSSH connection multiplexing.
+
+The first ssh started for a VM becomes the ControlMaster and leaves a control socket behind.
+Every later rsync or ssh for the same VM reuses that socket instead of doing a new key exchange.
+The masters outlive a single copy cycle (ControlPersist) and are closed when the VM leaves the
+ASG/VMSS or when the daemon stops.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import os
+import subprocess
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Suffix of the control sockets created in the control directory
+SOCKET_SUFFIX = '.sock'
+# Seconds to wait for "ssh -O exit" to close a master connection
+EXIT_TIMEOUT = 10
+
+
+class SSHConnectionPool:
+    """
+    Pool of multiplexed SSH master connections, one per VM hostname
+    Parameters:
+    - control_dir: The directory holding the control sockets. Keep the path short,
+      unix socket paths are limited to about 100 characters.
+    - persist: The number of seconds an idle master connection is kept open
+    """
+
+    def __init__(self, control_dir, persist=600):
+        self.control_dir = os.path.expanduser(control_dir)
+        self.persist = persist
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+
+    def control_path(self, hostname):
+        """
+        Return the path of the control socket of a VM
+        """
+        return os.path.join(self.control_dir, f"{hostname}{SOCKET_SUFFIX}")
+
+    def ssh_command(self, vm_info):
+        """
+        Build the ssh argv list for a VM that reuses (or creates) its master connection
+        Parameters:
+        - vm_info: A dictionary containing the hostname, username and key_filename
+        Returns:
+        - The ssh command as a list of arguments, without the destination
+        """
+        return [
+            'ssh',
+            '-o', 'StrictHostKeyChecking=no',
+            '-i', vm_info['key_filename'],
+            '-o', 'ControlMaster=auto',
+            '-o', f"ControlPath={self.control_path(vm_info['hostname'])}",
+            '-o', f"ControlPersist={self.persist}",
+            '-o', 'ServerAliveInterval=30',
+        ]
+
+    def hostnames(self):
+        """
+        Return the hostnames that currently have a control socket
+        """
+        try:
+            names = os.listdir(self.control_dir)
+        except FileNotFoundError:
+            return set()
+        return {name[:-len(SOCKET_SUFFIX)] for name in names if name.endswith(SOCKET_SUFFIX)}
+
+    def close(self, hostname):
+        """
+        Close the master connection of a VM
+        """
+        control_path = self.control_path(hostname)
+        if not os.path.exists(control_path):
+            return
+        logger.info("Closing SSH master connection to %s", hostname)
+        try:
+            # With an explicit ControlPath the destination is only used for display
+            subprocess.run(['ssh', '-o', f"ControlPath={control_path}", '-O', 'exit', hostname],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           stdin=subprocess.DEVNULL, timeout=EXIT_TIMEOUT, check=False)
+        except (OSError, subprocess.TimeoutExpired) as exit_error:
+            logger.warning("Failed to close SSH master connection to %s: %s", hostname, exit_error)
+        # The socket is left behind if the master already died
+        if os.path.exists(control_path):
+            try:
+                os.remove(control_path)
+            except OSError:
+                pass
+
+    def prune(self, vm_list, host_locks=None):
+        """
+        Close the master connections of VMs that are no longer in the VM list
+        Parameters:
+        - vm_list: The current list of VMs
+        - host_locks: Optional limits.HostLocks; every connection is then closed under the lock of
+          its VM, so that a copy still running on it is not cut off
+        """
+        active = {vm_info['hostname'] for vm_info in vm_list}
+        for hostname in self.hostnames() - active:
+            if host_locks:
+                with host_locks.get(hostname):
+                    self.close(hostname)
+            else:
+                self.close(hostname)
+
+    def close_all(self):
+        """
+        Close every master connection in the pool
+        """
+        for hostname in self.hostnames():
+            self.close(hostname)
@@ -0,0 +1,91 @@
+"""
+This module persists small pieces of state (cached detection results, manifests, offsets)
+as JSON files in the state directory, so that they survive a restart of the daemon.
+
+Files are written atomically (temporary file + rename), so a crash never leaves a
+truncated state file behind.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+
+# Function to read a JSON state file
+def read_json(path, default=None):
+    """
+    Read a JSON state file
+    Parameters:
+    - path: The path of the state file
+    - default: The value returned if the file is missing or unreadable
+    Returns:
+    - The decoded content of the file, or default
+    """
+    try:
+        with open(path, encoding="utf-8") as f_stream:
+            return json.load(f_stream)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as read_error:
+        logger.warning("Ignoring unreadable state file %s: %s", path, read_error)
+        return default
+
+
+# Function to write a JSON state file atomically
+def write_json(path, data):
+    """
+    Write a JSON state file atomically
+    Parameters:
+    - path: The path of the state file. Missing parent directories are created.
+    - data: The JSON serializable data to write
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as f_stream:
+            json.dump(data, f_stream)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# Function to remove a state file
+def remove(path):
+    """
+    Remove a state file if it exists
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,8 +1,8 @@
 """
 This module is responsible for synchronizing data between different cloud services. 
 
-It uses multithreading for concurrent operations and supports both 'thread' and 'gevent' concurrency models. 
-The concurrency model can be set by changing the CONCURRENCY_MODEL variable.
+It uses multithreading for concurrent operations and supports the 'thread', 'gevent' and 'asyncio' concurrency models.
+The concurrency model can be set with the concurrency_model setting.
 
 It uses the boto3 library for AWS operations and the azure-mgmt libraries for Azure operations.
 
@@ -29,31 +29,43 @@ SOFTWARE.
 Author: Shailendra Dharmistan, Zcaler Inc.
 """
 
+import asyncio
 import json
 import os
+import shlex
 import sys
+import tempfile
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 
-import boto3
 import gevent
+import gevent.pool
 import requests
 import schedule
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network import NetworkManagementClient
+from botocore.exceptions import BotoCoreError, ClientError
 
-CONCURRENCY_MODEL = 'thread'
-if CONCURRENCY_MODEL == 'gevent':
-    # Patch all to make standard library cooperative
-    from gevent import monkey
-    monkey.patch_all()
+from cc_fsync import async_engine, cas, clients, digest, drift, inventory, limits, profiles, snapshots, state, tail, \
+    transfer
+from cc_fsync.lifecycle import LifecycleConsumer
+from cc_fsync.manifest import Manifest
+from cc_fsync.sftp import SFTPBackend
+from cc_fsync.ssh_pool import SSHConnectionPool
+from cc_fsync.watch import WatchManager
 
 # Constants
 AWS_TOKEN_URL = 'http://169.254.169.254/latest/api/token'
 AWS_METADATA_URL = 'http://169.254.169.254/latest/meta-data/'
 AWS_METADATA_HEADERS = {'X-aws-ec2-metadata-token-ttl-seconds': '21600'}
+AZURE_METADATA_URL = 'http://169.254.169.254/metadata/instance?api-version=2021-02-01'
+# Supported values of the cloud setting
+CLOUD_ENVIRONMENTS = ('aws', 'azure', 'static')
+# Remote compressor and local decompressor of the seed archive, per seed_compression setting
+SEED_COMPRESSORS = {
+    'zstd': (['zstd', '-3', '-T0', '-q', '-c'], ['zstd', '-d', '-q', '-c']),
+    'gzip': (['gzip', '-1', '-c'], ['gzip', '-d', '-c']),
+    'none': None,
+}
 
 
 # Get the logger that was created in __main__.py
@@ -82,20 +94,137 @@ def load_settings(settings_file='./settings.json'):
 # Load settings
 settings = load_settings()
 
-# Configuration for AWS and Azure
-aws_region = settings['aws_region']
-asg_name = settings['asg_name']
-subscription_id = settings['subscription_id']
-resource_group = settings['resource_group']
-vmss_name = settings['vmss_name']
+# Concurrency model used to copy the VMs: 'thread', 'gevent', 'asyncio' or 'sequential'
+CONCURRENCY_MODEL = settings.get('concurrency_model', 'thread')
+if CONCURRENCY_MODEL == 'gevent':
+    # Patch all to make standard library cooperative
+    from gevent import monkey
+    monkey.patch_all()
+
+# Configuration for AWS and Azure. Not needed when the inventory setting lists the sources.
+aws_region = settings.get('aws_region')
+asg_name = settings.get('asg_name')
+subscription_id = settings.get('subscription_id')
+resource_group = settings.get('resource_group')
+vmss_name = settings.get('vmss_name')
 ssh_key_path = settings['ssh_key_path']
 ssh_username = settings['ssh_username']
 remote_paths = settings['remote_paths']
 interval = settings.get('interval', 60)  # Default to 60 seconds if not specified
-base_local_dir = settings.get('base_local_dir', './')  # Default to current directory if not specified
+# Default to current directory if not specified. Local paths are made absolute when the settings are loaded,
+# as --daemon changes the working directory to / before the first cycle.
+base_local_dir = os.path.abspath(settings.get('base_local_dir', './'))
 sudo_path = settings.get('sudo_path', '/usr/local/bin/sudo')  # Default to /usr/local/bin/sudo if not specified
 # device index for network interface to get the private IP address. Must be an integer.
 device_index = settings.get('device_index', 1)
+# Directory holding the state that survives restarts (cached cloud environment, ...)
+state_dir = os.path.abspath(settings.get('state_dir', './.cc-fsync'))
+cloud_env_file = os.path.join(state_dir, 'cloud_env.json')
+# Skip the metadata probing entirely when the cloud environment is configured
+cloud_override = settings.get('cloud')
+if cloud_override and cloud_override not in CLOUD_ENVIRONMENTS:
+    logger.critical("Invalid cloud setting '%s', expected one of %s", cloud_override, ', '.join(CLOUD_ENVIRONMENTS))
+    sys.exit(1)
+# Several ASGs, VMSSes and static lists discovered together (see validate_inventory)
+inventory_sources = settings.get('inventory') or []
+# 'poll' discovers the VMs on every cycle, 'events' follows ASG lifecycle hook notifications from SQS
+inventory_mode = settings.get('inventory_mode', 'poll')
+if inventory_mode not in ('poll', 'events') or (inventory_mode == 'events' and not settings.get('lifecycle_queue_url')):
+    logger.critical("Invalid inventory_mode '%s': expected 'poll', or 'events' with lifecycle_queue_url", inventory_mode)
+    sys.exit(1)
+if inventory_mode == 'events' and not (settings.get('lifecycle_region') or aws_region):
+    logger.critical("inventory_mode 'events' requires lifecycle_region or aws_region")
+    sys.exit(1)
+# Number of seconds the discovered VM list is reused before discovering again. 0 discovers on every cycle.
+# In events mode the full discovery only resyncs notifications that may have been missed.
+inventory_ttl = settings.get('inventory_ttl', 3600 if inventory_mode == 'events' else 0)
+# Number of instance IDs per DescribeInstances call, and number of calls run concurrently
+ec2_batch_size = settings.get('ec2_batch_size', 100)
+discovery_concurrency = settings.get('discovery_concurrency', 8)
+# Maximum number of seconds a single transfer may run before it is killed. 0 disables the deadline.
+transfer_timeout = settings.get('transfer_timeout', 600) or None
+# Keep one multiplexed SSH connection per VM across cycles instead of connecting for every rsync
+ssh_multiplexing = settings.get('ssh_multiplexing', True)
+ssh_control_dir = settings.get('ssh_control_dir', '~/.cc-fsync/cm')
+ssh_control_persist = settings.get('ssh_control_persist', 600)
+# 'rsync' forks rsync over ssh, 'sftp' copies with paramiko and needs neither binary
+transfer_backend = settings.get('transfer_backend', 'rsync')
+if transfer_backend not in ('rsync', 'sftp'):
+    logger.critical("Invalid transfer_backend '%s': expected 'rsync' or 'sftp'", transfer_backend)
+    sys.exit(1)
+# Command starting the SFTP server on the VMs with root privileges; empty uses the sftp subsystem
+sftp_server_command = settings.get('sftp_server_command', f"{sudo_path} /usr/libexec/sftp-server")
+sftp_backend = SFTPBackend(sftp_server_command or None, settings.get('ssh_port', 22)) \
+    if transfer_backend == 'sftp' else None
+# Stream the first copy of a VM as one compressed tar archive instead of rsync's file by file transfer
+seed_new_vms = settings.get('seed_new_vms', True)
+seed_compression = settings.get('seed_compression', 'zstd')
+if seed_compression not in SEED_COMPRESSORS:
+    logger.critical("Invalid seed_compression '%s': expected one of %s", seed_compression, ', '.join(SEED_COMPRESSORS))
+    sys.exit(1)
+# rsync options per remote path, e.g. zstd and --append-verify for logs, --checksum for small configs
+try:
+    rsync_profiles, path_profiles = profiles.validate_profiles(settings.get('transfer_profiles'),
+                                                               settings.get('path_profiles'))
+except ValueError as profiles_error:
+    logger.critical("Invalid transfer_profiles setting: %s", profiles_error)
+    sys.exit(1)
+# Append-only remote directories copied by fetching only the bytes added since the last cycle
+tail_paths = {profiles.normalize_path(remote_path) for remote_path in settings.get('tail_paths', [])}
+# Ask every VM with one cheap ssh command what changed and skip the transfers of unchanged paths
+change_detection = settings.get('change_detection', True)
+digest_manifest = digest.DigestManifest(os.path.join(state_dir, 'digests')) if change_detection else None
+# Store identical files of all VMs once, hardlinked from every host directory
+dedup_store = cas.ContentStore(
+    os.path.abspath(settings.get('dedup_store_dir') or os.path.join(base_local_dir, '.cc-fsync-objects'))) \
+    if settings.get('dedup_store', False) else None
+# Per local path, the start of the oldest transfer whose in-place metadata changes were not repaired yet
+dedup_unrepaired = {}
+# Hardlinked point-in-time snapshot of the local copy of a VM after every cycle that copied something
+try:
+    snapshot_store = snapshots.SnapshotStore(
+        os.path.abspath(settings.get('snapshots_dir') or os.path.join(base_local_dir, '.cc-fsync-snapshots')),
+        snapshots.validate_retention(settings['snapshots'])) if settings.get('snapshots') else None
+except ValueError as snapshots_error:
+    logger.critical("Invalid snapshots setting: %s", snapshots_error)
+    sys.exit(1)
+# SQLite index of every copied file (host, path, size, mtime, hash, cycle), queried with 'cc_fsync manifest'
+file_manifest = Manifest(os.path.abspath(settings.get('manifest_db') or os.path.join(state_dir, 'manifest.db'))) \
+    if settings.get('manifest', False) else None
+# Id of the current cycle in the manifest, set by discover_vms
+cycle_id = None
+# Remote paths compared across the VMs after every cycle, e.g. ["/etc/janus", "/etc/nimbus"]
+drift_paths = settings.get('drift_paths', [])
+if drift_paths and not file_manifest:
+    logger.critical("Invalid settings: drift_paths needs the manifest setting")
+    sys.exit(1)
+drift_report_file = os.path.abspath(settings.get('drift_report') or os.path.join(state_dir, 'drift.json'))
+# Id of the last cycle a drift report was written for
+drift_reported_cycle = None
+# Watch the remote paths with inotify over ssh and copy changed files right away, on top of the polling
+push_mode = settings.get('push_mode', False)
+# Seconds without new changes before the changed files of a VM are copied
+push_debounce = settings.get('push_debounce', 2)
+# Pull all remote paths of a VM with a single rsync session instead of one rsync per path
+batch_remote_paths = settings.get('batch_remote_paths', True)
+# Maximum number of VMs copied at the same time, honored by every concurrency model
+max_concurrency = settings.get('max_concurrency', 64)
+# Optional caps on the number of VMs copied at the same time per availability zone and/or subnet
+try:
+    concurrency_limits = limits.validate_limits(settings.get('concurrency_limits'))
+except ValueError as limits_error:
+    logger.critical("Invalid concurrency_limits setting: %s", limits_error)
+    sys.exit(1)
+# Shared by the copy cycles, the push copies and the final copies of terminating VMs
+group_limiter = limits.GroupLimiter(concurrency_limits, max_concurrency)
+# A VM is copied by one of them at a time
+host_locks = limits.HostLocks()
+
+ssh_pool = SSHConnectionPool(ssh_control_dir, ssh_control_persist) if ssh_multiplexing else None
+# VM dictionaries of the instances seen by the previous discovery, per ASG/VMSS
+discovery_cache = {}
+# VMs of every inventory source as of its last successful discovery, per index in the inventory setting
+last_source_vm_lists = {}
 
 
 # Function to get AWS metadata token for IMDSv2
@@ -112,29 +241,38 @@ def get_aws_metadata_token():
         logger.error("Exception occurred while getting AWS metadata token: %s", request_exception)
     return None
 
-# Detect cloud environment
-def detect_cloud_environment():
+# Function to check for an AWS environment
+def probe_aws():
     """
-    Detect the cloud environment by querying the metadata service
+    Check for AWS environment by querying the metadata service with IMDSv2
+    Returns:
+    - 'aws' if the metadata service answered, None otherwise
     """
-    # Check for AWS environment by querying the metadata service with IMDSv2
     token = get_aws_metadata_token()
-    if token:
-        try:
-            # Check for AWS environment by querying the metadata service
-            response = requests.get(AWS_METADATA_URL, headers={'X-aws-ec2-metadata-token': token}, timeout=1)
-            if response.status_code == 200:
-                logger.info("Detected AWS environment")
-                return 'aws'
-            # log the error with response body and status code
-            logger.info("Failed to query AWS metadata service: %s - %s", response.status_code, response.text)
-        except requests.RequestException as request_exception:
-            logger.info("Failed to query AWS metadata service: %s", request_exception)
+    if not token:
+        return None
+    try:
+        # Check for AWS environment by querying the metadata service
+        response = requests.get(AWS_METADATA_URL, headers={'X-aws-ec2-metadata-token': token}, timeout=1)
+        if response.status_code == 200:
+            logger.info("Detected AWS environment")
+            return 'aws'
+        # log the error with response body and status code
+        logger.info("Failed to query AWS metadata service: %s - %s", response.status_code, response.text)
+    except requests.RequestException as request_exception:
+        logger.info("Failed to query AWS metadata service: %s", request_exception)
+    return None
 
+# Function to check for an Azure environment
+def probe_azure():
+    """
+    Check for Azure environment by querying the metadata service
+    Returns:
+    - 'azure' if the metadata service answered, None otherwise
+    """
     try:
-        # Check for Azure environment by querying the metadata service
         headers = {'Metadata': 'true'}
-        response = requests.get('http://169.254.169.254/metadata/instance?api-version=2021-02-01', headers=headers, timeout=1)
+        response = requests.get(AZURE_METADATA_URL, headers=headers, timeout=1)
         if response.status_code == 200:
             logger.info("Detected Azure environment")
             return 'azure'
@@ -142,17 +280,76 @@ def detect_cloud_environment():
         logger.info("Failed to query Azure metadata service: %s - %s", response.status_code, response.text)
     except requests.RequestException as request_exception:
         logger.info("Failed to query Azure metadata service:%s", request_exception)
+    return None
+
+# Detect cloud environment
+def detect_cloud_environment():
+    """
+    Detect the cloud environment by querying the AWS and Azure metadata services concurrently.
+    The first probe that succeeds wins, the other one is not waited for.
+    """
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = [executor.submit(probe_aws), executor.submit(probe_azure)]
+        for future in as_completed(futures):
+            cloud_env = future.result()
+            if cloud_env:
+                return cloud_env
+    finally:
+        executor.shutdown(wait=False)
     logger.error("Unsupported cloud environment")
     return None
 
+# Function to get the cloud environment, detecting it only when it is not known yet
+def get_cloud_environment(refresh=False):
+    """
+    Get the cloud environment from the cloud setting, from memory, then from the state file,
+    and only probe the metadata services if none of them knows it
+    Parameters:
+    - refresh: Probe the metadata services even if the cloud environment is known
+    Returns:
+    - 'aws', 'azure', 'static' or None
+    """
+    global CLOUD_ENV
+    if cloud_override:
+        CLOUD_ENV = cloud_override
+        return CLOUD_ENV
+    if CLOUD_ENV and not refresh:
+        return CLOUD_ENV
+    if not refresh:
+        cached = state.read_json(cloud_env_file, {}).get('cloud')
+        if cached:
+            logger.info("Using cached %s environment from %s", cached, cloud_env_file)
+            CLOUD_ENV = cached
+            return CLOUD_ENV
+    CLOUD_ENV = detect_cloud_environment()
+    if CLOUD_ENV:
+        try:
+            state.write_json(cloud_env_file, {'cloud': CLOUD_ENV, 'detected_at': time.time()})
+        except OSError as write_error:
+            logger.warning("Failed to cache the cloud environment in %s: %s", cloud_env_file, write_error)
+    return CLOUD_ENV
+
+# Function to forget the cached cloud environment
+def invalidate_cloud_environment():
+    """
+    Forget the cached cloud environment, so that it is probed again on the next use.
+    Called on discovery errors and on demand (SIGHUP).
+    """
+    global CLOUD_ENV
+    CLOUD_ENV = None
+    state.remove(cloud_env_file)
+
 # Function to get and create VM list from the settings.json file
-def get_static_vm_list():
+def get_static_vm_list(hosts=None):
     """
     Get and create a list of VMs from the settings.json file
+    Parameters:
+    - hosts: The hostnames of the VMs, defaults to the cc_vms setting
     """
     vm_list = []
-    if settings.get('cc_vms'):
-        cc_vms = settings['cc_vms']
+    cc_vms = settings.get('cc_vms') if hosts is None else hosts
+    if cc_vms:
         for cc_vm in cc_vms:
             vm_list.append({
                 'hostname': cc_vm,
@@ -162,85 +359,655 @@ def get_static_vm_list():
             })
     return vm_list
 
+# Function to split a list into batches
+def chunk(items, size):
+    """
+    Split a list into batches of at most size items
+    """
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+# Function to convert an EC2 instance into a VM dictionary
+def ec2_instance_to_vm_info(instance):
+    """
+    Convert an EC2 instance description into a VM dictionary
+    Parameters:
+    - instance: An instance as returned by ec2.describe_instances
+    Returns:
+    - The VM dictionary, or None if the instance has no network interface with the configured device index
+    """
+    # get the ip address of the network interface with the configured device index
+    network_interface = next((interface for interface in instance.get('NetworkInterfaces', []) if interface['Attachment']['DeviceIndex'] == device_index), None)
+    host_ip = network_interface['PrivateIpAddress'] if network_interface else None
+    if not host_ip:
+        return None
+    return {
+        'hostname': host_ip,
+        'username': ssh_username,
+        'key_filename': ssh_key_path,
+        'remote_paths': remote_paths,  # Use remote paths from settings
+        'instance_id': instance['InstanceId'],
+        'zone': instance.get('Placement', {}).get('AvailabilityZone'),
+        'subnet': network_interface.get('SubnetId')
+    }
+
+# Function to get the InService instance IDs of ASGs
+def get_asg_instance_ids(autoscaling, asg_names):
+    """
+    Get the InService instance IDs of one or more Auto Scaling Groups, following pagination
+    Parameters:
+    - autoscaling: The boto3 autoscaling client
+    - asg_names: The names of the Auto Scaling Groups
+    Returns:
+    - A list of instance IDs
+    """
+    instance_ids = []
+    paginator = autoscaling.get_paginator('describe_auto_scaling_groups')
+    # DescribeAutoScalingGroups accepts at most 100 names per call
+    for names in chunk(asg_names, 100):
+        for page in paginator.paginate(AutoScalingGroupNames=names):
+            for group in page['AutoScalingGroups']:
+                instance_ids.extend(instance['InstanceId'] for instance in group['Instances']
+                                    if instance['LifecycleState'] == 'InService')
+    return instance_ids
+
+# Function to describe a batch of EC2 instances
+def describe_instance_batch(ec2, instance_ids):
+    """
+    Describe a batch of EC2 instances, following pagination
+    Parameters:
+    - ec2: The boto3 ec2 client
+    - instance_ids: The instance IDs to describe
+    Returns:
+    - A list of instance descriptions
+    """
+    instances = []
+    paginator = ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(InstanceIds=instance_ids):
+        for reservation in page['Reservations']:
+            instances.extend(reservation['Instances'])
+    return instances
+
+# Function to describe EC2 instances in concurrent batches
+def describe_instances(ec2, instance_ids):
+    """
+    Describe EC2 instances in batches of ec2_batch_size IDs, fetched concurrently
+    Parameters:
+    - ec2: The boto3 ec2 client
+    - instance_ids: The instance IDs to describe
+    Returns:
+    - A list of instance descriptions
+    """
+    # An empty InstanceIds list would describe every instance of the region
+    if not instance_ids:
+        return []
+    batches = chunk(instance_ids, ec2_batch_size)
+    if len(batches) == 1:
+        return describe_instance_batch(ec2, batches[0])
+    instances = []
+    with ThreadPoolExecutor(max_workers=min(len(batches), discovery_concurrency)) as executor:
+        for batch_instances in executor.map(lambda batch: describe_instance_batch(ec2, batch), batches):
+            instances.extend(batch_instances)
+    return instances
+
+# Function to get the VM dictionary of a single EC2 instance
+def get_ec2_vm_info(instance_id, region=None):
+    """
+    Describe a single EC2 instance and convert it into a VM dictionary
+    Parameters:
+    - instance_id: The EC2 instance ID
+    - region: The AWS region of the instance, defaults to the aws_region setting
+    Returns:
+    - The VM dictionary, or None if the instance has no usable network interface
+    """
+    ec2 = clients.get_aws_client('ec2', region or aws_region)
+    for instance in describe_instances(ec2, [instance_id]):
+        return ec2_instance_to_vm_info(instance)
+    return None
+
 # Function to get instances from AWS ASG
-def get_asg_instances():
+def get_asg_instances(names=None, region=None):
     """
-    Get instances from AWS Auto Scaling Group
+    Get instances from AWS Auto Scaling Groups
+    Parameters:
+    - names: The name or list of names of the Auto Scaling Groups, defaults to the asg_name setting
+    - region: The AWS region of the groups, defaults to the aws_region setting
+    Returns:
+    - The list of VMs, or None if the discovery failed
+
+    Only instances that were not seen by the previous call are described with DescribeInstances;
+    the VM dictionaries of known instances are reused.
     """
-    client = boto3.client('autoscaling', region_name=aws_region)
-    ec2 = boto3.client('ec2', region_name=aws_region)
+    names = asg_name if names is None else names
+    region = region or aws_region
+    client = clients.get_aws_client('autoscaling', region)
+    ec2 = clients.get_aws_client('ec2', region)
+    asg_names = names if isinstance(names, list) else [names]
     try:
-        response = client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
-    except client.exceptions.ClientError as client_error:
+        instance_ids = get_asg_instance_ids(client, asg_names)
+    except (BotoCoreError, ClientError) as client_error:
         logger.error("Failed to get instances from ASG: %s", client_error)
-        return []
-    instance_ids = [instance['InstanceId'] for instance in response['AutoScalingGroups'][0]['Instances'] if instance['LifecycleState'] == 'InService']
+        invalidate_cloud_environment()
+        clients.reset()
+        return None
+    cache_key = (region, tuple(sorted(asg_names)))
+    known = discovery_cache.get(cache_key, {})
     try:
-        reservations = ec2.describe_instances(InstanceIds=instance_ids)
-    except client.exceptions.ClientError as client_error:
+        reservations = describe_instances(ec2, [instance_id for instance_id in instance_ids if instance_id not in known])
+    except (BotoCoreError, ClientError) as client_error:
         logger.error("Failed to get instances from EC2: %s", client_error)
-        return []
-    instances = []
+        invalidate_cloud_environment()
+        clients.reset()
+        return None
+    described = {}
 
-    for reservation in reservations['Reservations']:
-        for instance in reservation['Instances']:
-            # get the ip address of the network interface with device index 1
-            network_interface = next((interface for interface in instance['NetworkInterfaces'] if interface['Attachment']['DeviceIndex'] == device_index), None)
-            host_ip = network_interface['PrivateIpAddress'] if network_interface else None
-            if host_ip:
-                instances.append({
-                    'hostname': host_ip,
-                    'username': ssh_username,
-                    'key_filename': ssh_key_path,
-                    'remote_paths': remote_paths  # Use remote paths from settings
-                })
+    for instance in reservations:
+        vm_info = ec2_instance_to_vm_info(instance)
+        if vm_info:
+            described[instance['InstanceId']] = vm_info
 
-    return instances
+    instances_by_id = {instance_id: known.get(instance_id) or described.get(instance_id) for instance_id in instance_ids}
+    discovery_cache[cache_key] = {instance_id: vm_info for instance_id, vm_info in instances_by_id.items() if vm_info}
+    return list(discovery_cache[cache_key].values())
 
 # Function to get instances from Azure VMSS
-def get_vmss_instances():
+def get_vmss_instances(vmss=None, group=None, subscription=None):
     """
     Get instances from Azure Virtual Machine Scale Set
+    Parameters:
+    - vmss: The name of the scale set, defaults to the vmss_name setting
+    - group: The resource group of the scale set, defaults to the resource_group setting
+    - subscription: The Azure subscription id, defaults to the subscription_id setting
+    Returns:
+    - The list of VMs, or None if the discovery failed
+
+    The NICs of all instances are fetched with a single paged call listing the scale set
+    network interfaces and joined to the instances in memory, instead of one lookup per instance.
+    The management clients are shared across cycles (see the clients module). When no instance
+    joined the scale set since the previous call, the NICs are not listed at all.
     """
-    credential = DefaultAzureCredential()
-    compute_client = ComputeManagementClient(credential, subscription_id)
+    vmss = vmss or vmss_name
+    group = group or resource_group
+    subscription = subscription or subscription_id
+    compute_client = clients.get_compute_client(subscription)
+    network_client = clients.get_network_client(subscription)
+    cache_key = (subscription, group, vmss)
+    known = discovery_cache.get(cache_key, {})
     try:
-        instances = compute_client.virtual_machine_scale_set_vms.list(resource_group, vmss_name)
+        instances = list(compute_client.virtual_machine_scale_set_vms.list(group, vmss))
+        nics_by_id = {}
+        if any(instance.id not in known for instance in instances):
+            nics = network_client.network_interfaces.list_virtual_machine_scale_set_network_interfaces(group, vmss)
+            # Resource IDs are case insensitive
+            nics_by_id = {nic.id.lower(): nic for nic in nics}
     except Exception as client_error:
         logger.error("Failed to get instances from VMSS: %s", client_error)
-        return []
+        invalidate_cloud_environment()
+        clients.reset()
+        return None
     vm_list = []
+    discovered = {}
 
     for instance in instances:
-        # Get instance details
-        network_profile = instance.network_profile.network_interfaces[device_index]
-        nic_id = network_profile.id
-        nic_name = nic_id.split('/')[-1]
-
-        # Get NIC details
-        network_client = NetworkManagementClient(credential, subscription_id)
-        nic = network_client.network_interfaces.get(resource_group, nic_name)
-
-        # Get private IP
-        private_ip = None
-        for ip_config in nic.ip_configurations:
-            if ip_config.private_ip_address:
-                private_ip = ip_config.private_ip_address.id
-                break
+        if instance.id in known:
+            discovered[instance.id] = known[instance.id]
+            vm_list.append(known[instance.id])
+            continue
+        # Get the NIC with the configured device index
+        network_interfaces = instance.network_profile.network_interfaces
+        if len(network_interfaces) <= device_index:
+            logger.warning("Instance %s has no network interface with index %s", instance.name, device_index)
+            continue
+        nic = nics_by_id.get(network_interfaces[device_index].id.lower())
+        if nic is None:
+            logger.warning("Network interface of instance %s not found", instance.name)
+            continue
 
-        if private_ip:
-            private_ip = network_client.private_ip_addresses.get(resource_group, private_ip.split('/')[-1]).ip_address
+        # Get private IP, preferring the primary IP configuration
+        ip_configs = sorted(nic.ip_configurations or [], key=lambda ip_config: not ip_config.primary)
+        ip_config = next((ip_config for ip_config in ip_configs if ip_config.private_ip_address), None)
 
-        if private_ip:
-            vm_list.append({
-                'hostname': private_ip,
+        if ip_config:
+            discovered[instance.id] = {
+                'hostname': ip_config.private_ip_address,
                 'username': ssh_username,
                 'key_filename': ssh_key_path,
-                'remote_paths': remote_paths  # Use remote paths from settings
-            })
+                'remote_paths': remote_paths,  # Use remote paths from settings
+                'instance_id': instance.id,
+                'zone': instance.zones[0] if instance.zones else None,
+                'subnet': ip_config.subnet.id if ip_config.subnet else None
+            }
+            vm_list.append(discovered[instance.id])
 
+    discovery_cache[cache_key] = discovered
     return vm_list
 
+# Function to build the ssh command used to reach a VM
+def get_ssh_command(vm_info):
+    """
+    Build the ssh argv list used to connect to a VM, without the destination
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username and key_filename
+    Returns:
+    - The ssh command as a list of arguments
+    """
+    if ssh_pool:
+        return ssh_pool.ssh_command(vm_info)
+    return ['ssh', '-o', 'StrictHostKeyChecking=no', '-i', vm_info['key_filename']]
+
+# Function to build the rsync command for one remote path
+def build_rsync_command(vm_info, remote_path, local_path):
+    """
+    Build the rsync argv list used to copy a remote path from a VM
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - remote_path: The remote directory to copy
+    - local_path: The local directory to copy the files to
+    Returns:
+    - The rsync command as a list of arguments
+    """
+    ssh_command = shlex.join(get_ssh_command(vm_info))
+    options = rsync_profiles[profiles.profile_for(remote_path, path_profiles)]
+    return [
+        'rsync', '-a', '--stats', *options,
+        '-e', ssh_command,
+        f"--rsync-path={sudo_path} rsync",
+        f"{vm_info['username']}@{vm_info['hostname']}:{remote_path}/",
+        f"{local_path}/",
+    ]
+
+# Function to build a single rsync command covering several remote paths
+def build_batch_rsync_command(vm_info, remote_paths, host_dir, profile=profiles.DEFAULT_PROFILE):
+    """
+    Build one rsync argv list that copies all remote paths of a VM in a single session
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - remote_paths: The remote directories to copy
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    - profile: The name of the transfer profile of the remote paths
+    Returns:
+    - The rsync command as a list of arguments
+
+    --relative recreates every remote path below host_dir, so /etc/janus/ is stored in
+    <host_dir>/etc/janus/ exactly like a per-path transfer would do.
+    """
+    ssh_command = shlex.join(get_ssh_command(vm_info))
+    sources = [f"{vm_info['username']}@{vm_info['hostname']}:{remote_path}/" for remote_path in remote_paths]
+    return [
+        'rsync', '-a', '--stats', '--relative', *rsync_profiles[profile],
+        '-e', ssh_command,
+        f"--rsync-path={sudo_path} rsync",
+        *sources,
+        f"{host_dir}/",
+    ]
+
+# Function to check if a VM has never been copied before
+def needs_seed(host_dir):
+    """
+    Return True if the first copy of a VM should be streamed as a tar archive
+    Parameters:
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    """
+    return seed_new_vms and not (os.path.isdir(host_dir) and os.listdir(host_dir))
+
+# Function to build the tar-over-ssh pipeline of the first copy of a VM
+def build_seed_command(vm_info, remote_paths, host_dir):
+    """
+    Build the command streaming all remote paths of a VM as one tar archive over ssh
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - remote_paths: The remote directories to copy
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    Returns:
+    - The command as a list of arguments
+
+    The archive is made relative to /, so /etc/janus/ is unpacked into <host_dir>/etc/janus/ like
+    rsync would do. It is unpacked while it arrives; pipefail makes any failing stage fail the command.
+    """
+    relative_paths = [remote_path.strip('/') for remote_path in remote_paths]
+    remote_command = shlex.join([sudo_path, 'tar', '-C', '/', '-cf', '-', *relative_paths])
+    unpack = shlex.join(['tar', '-xf', '-', '-C', host_dir])
+    compressors = SEED_COMPRESSORS[seed_compression]
+    if compressors:
+        remote_command = f"{remote_command} | {shlex.join(compressors[0])}"
+        unpack = f"{shlex.join(compressors[1])} | {unpack}"
+    ssh_command = get_ssh_command(vm_info) + [f"{vm_info['username']}@{vm_info['hostname']}", remote_command]
+    return ['bash', '-o', 'pipefail', '-c', f"{shlex.join(ssh_command)} | {unpack}"]
+
+# Function to run the first copy of a VM
+def seed_vm(vm_info, remote_paths, host_dir, timeout=None):
+    """
+    Stream the remote paths of a new VM as one tar archive, falling back to rsync if that fails
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - remote_paths: The remote directories to copy
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    - timeout: The maximum number of seconds the transfer may run, or None for no limit
+    Returns:
+    - A result dictionary (see transfer.new_result)
+    """
+    result = transfer.run_command(build_seed_command(vm_info, remote_paths, host_dir), timeout=timeout,
+                                  parse_output=None)
+    if transfer.succeeded(result):
+        result['bytes_transferred'] = sum(os.path.getsize(os.path.join(root, name))
+                                          for root, _, names in os.walk(host_dir) for name in names
+                                          if not os.path.islink(os.path.join(root, name)))
+        return result
+    if result['cancelled'] or result['timed_out']:
+        return result
+    # e.g. no zstd on the VM; later cycles would try the seed again as long as host_dir is empty
+    logger.warning("Seeding %s failed, falling back to rsync: %s", vm_info['hostname'], result['error'])
+    command = build_batch_rsync_command(vm_info, remote_paths, host_dir)
+    logger.info("Running command: %s", shlex.join(command))
+    return transfer.run_command(command, timeout=timeout)
+
+# Function to get the offsets state file of a VM
+def get_tail_state_file(hostname):
+    """
+    Return the path of the state file holding the tail offsets of a VM
+    """
+    return os.path.join(state_dir, 'tail', f"{hostname}.json")
+
+# Function to plan the tail transfer of an append-only remote directory
+def plan_tail_transfer(vm_info, remote_path, host_dir):
+    """
+    Build the transfer fetching only the new bytes of the files of a remote directory
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - remote_path: The remote directory, listed in tail_paths
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    Returns:
+    - A planned transfer (see transfer.run_plan)
+    """
+    local_path = os.path.join(host_dir, remote_path.lstrip('/'))
+    os.makedirs(local_path, exist_ok=True)
+    ssh_command = get_ssh_command(vm_info) + [f"{vm_info['username']}@{vm_info['hostname']}"]
+    return {
+        'remote_paths': [remote_path],
+        'command': ['tail', ssh_command[-1], remote_path],
+        'run': lambda timeout: tail.tail_sync(ssh_command, sudo_path, remote_path, local_path,
+                                              get_tail_state_file(vm_info['hostname']), timeout),
+    }
+
+# Function to plan the transfers of a VM
+def plan_transfers(vm_info, local_dir):
+    """
+    Create the local directories of a VM and build the transfers to run
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - local_dir: The base local directory to copy the files to
+    Returns:
+    - A list of dictionaries with the remote_paths and the command of each transfer
+      (see transfer.run_plan)
+    """
+    host_dir = os.path.join(local_dir, vm_info['hostname'])
+    plans = plan_backend_transfers(vm_info, host_dir)
+    if dedup_store:
+        for plan in plans:
+            start_dedup_transfer(host_dir, plan['remote_paths'])
+            add_on_success(plan, lambda paths=plan['remote_paths']: deduplicate(host_dir, paths))
+    if file_manifest:
+        for plan in plans:
+            add_on_success(plan, lambda paths=plan['remote_paths']: index_files(vm_info['hostname'], host_dir, paths))
+    if snapshot_store and plans:
+        # Runs after the transfers of the VM, unchanged files are hardlinked to the previous snapshot
+        plans.append(snapshot_store.plan_snapshot(vm_info['hostname'], host_dir))
+    return plans
+
+# Function to chain a success callback to a planned transfer
+def add_on_success(plan, callback):
+    """
+    Call callback after the other on_success functions of a plan, if its transfer succeeded
+    """
+    previous = plan.get('on_success')
+
+    def on_success():
+        if previous:
+            previous()
+        callback()
+    plan['on_success'] = on_success
+
+# Function to check if the local copies of a remote path only grow
+def is_append_only(remote_path):
+    """
+    Return True for remote paths whose local files are appended to on every cycle (tail_paths and
+    --append-verify profiles), e.g. logs
+    """
+    options = rsync_profiles[profiles.profile_for(remote_path, path_profiles)]
+    return profiles.normalize_path(remote_path) in tail_paths or '--append-verify' in options
+
+# Function to check if the local copy of a remote path is changed in place
+def is_modified_in_place(remote_path):
+    """
+    Return True for remote paths whose local files are appended to or rewritten in place,
+    which would modify every VM sharing a deduplicated file
+    """
+    options = rsync_profiles[profiles.profile_for(remote_path, path_profiles)]
+    return is_append_only(remote_path) or '--inplace' in options
+
+# Function to remember the start of a transfer of deduplicated files
+def start_dedup_transfer(host_dir, remote_paths_list):
+    """
+    Record when a transfer of remote paths starts, unless an earlier transfer was not repaired yet
+    (see deduplicate). A failed transfer may have changed metadata in place before it failed.
+    """
+    now = time.time()
+    for remote_path in remote_paths_list:
+        if not is_modified_in_place(remote_path):
+            dedup_unrepaired.setdefault(os.path.join(host_dir, remote_path.lstrip('/')), now)
+
+# Function to deduplicate the copied files of a VM
+def deduplicate(host_dir, remote_paths_list):
+    """
+    Give the files whose shared metadata the transfers changed in place a copy of their own, then
+    hardlink the copied files of remote paths into the dedup store
+    Parameters:
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    - remote_paths_list: The remote paths that were copied
+    """
+    for remote_path in remote_paths_list:
+        if is_modified_in_place(remote_path):
+            continue
+        local_path = os.path.join(host_dir, remote_path.lstrip('/'))
+        since = dedup_unrepaired.pop(local_path, None)
+        if since is not None:
+            # One second of slack for file systems with a coarse timestamp granularity
+            dedup_store.repair(local_path, since - 1)
+        hashed, saved = dedup_store.ingest(local_path)
+        if hashed:
+            logger.debug("Deduplicated %d file(s) of %s in %s, %d bytes saved", hashed, remote_path, host_dir, saved)
+    dedup_store.maybe_gc()
+
+# Function to record the copied files of a VM in the manifest
+def index_files(hostname, host_dir, remote_paths_list):
+    """
+    Update the manifest with the local copies of remote paths
+    Parameters:
+    - hostname: The hostname of the VM
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    - remote_paths_list: The remote paths that were copied
+    """
+    for remote_path in remote_paths_list:
+        if is_append_only(remote_path):
+            # Their files change on every cycle; hashing them would read every log end to end
+            continue
+        changed = file_manifest.update(hostname, host_dir, remote_path, cycle_id)
+        if changed:
+            logger.debug("Indexed %d changed file(s) of %s on %s", len(changed), remote_path, hostname)
+
+# Function to write the drift report of the current cycle
+def write_drift_report():
+    """
+    Compare the files of drift_paths across the VMs and write the report, once per cycle
+    """
+    global drift_reported_cycle
+    if not drift_paths or cycle_id is None or drift_reported_cycle == cycle_id:
+        return
+    drift_reported_cycle = cycle_id
+    try:
+        state.write_json(drift_report_file, drift.build_report(file_manifest, drift_paths, cycle_id))
+    except Exception as drift_error:
+        logger.error("Failed to write the drift report: %s", drift_error)
+
+# Function to plan the transfers of a VM with the configured backend
+def plan_backend_transfers(vm_info, host_dir):
+    """
+    Build the transfers of a VM with the SFTP backend, the seed archive or rsync
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    Returns:
+    - A list of planned transfers
+    """
+    if sftp_backend:
+        return sftp_backend.plan_transfers(vm_info, host_dir)
+    remote_paths_list = vm_info['remote_paths']
+    if needs_seed(host_dir):
+        # A new VM: one archive instead of one round trip per file, rsync deltas afterwards.
+        # Paths whose profile filters files or limits the bandwidth keep their rsync transfer.
+        seed_paths = [remote_path for remote_path in remote_paths_list
+                      if profiles.can_seed(rsync_profiles[profiles.profile_for(remote_path, path_profiles)])]
+        os.makedirs(host_dir, exist_ok=True)
+        plans = [{
+            'remote_paths': seed_paths,
+            'command': build_seed_command(vm_info, seed_paths, host_dir),
+            'run': lambda timeout: seed_vm(vm_info, seed_paths, host_dir, timeout),
+        }] if seed_paths else []
+        return plans + plan_rsync_transfers(vm_info, [remote_path for remote_path in remote_paths_list
+                                                      if remote_path not in seed_paths], host_dir)
+    digests = None
+    if digest_manifest:
+        ssh_command = get_ssh_command(vm_info) + [f"{vm_info['username']}@{vm_info['hostname']}"]
+        digests = digest.get_remote_digests(ssh_command, sudo_path, remote_paths_list)
+    if digests:
+        changed = digest_manifest.changed_paths(vm_info['hostname'], digests)
+        if not changed:
+            logger.info("Nothing changed on %s, skipping its transfers", vm_info['hostname'])
+            return []
+        remote_paths_list = changed
+    plans = plan_rsync_transfers(vm_info, remote_paths_list, host_dir)
+    if digests:
+        for plan in plans:
+            # Only a successful transfer makes its paths count as unchanged
+            add_on_success(plan, lambda paths=plan['remote_paths']: digest_manifest.save(
+                vm_info['hostname'], {remote_path: digests[remote_path] for remote_path in paths}))
+    return plans
+
+# Function to plan the rsync and tail transfers of a VM
+def plan_rsync_transfers(vm_info, remote_paths_list, host_dir):
+    """
+    Build the rsync commands and tail transfers copying remote paths of a VM
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - remote_paths_list: The remote paths to copy
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    Returns:
+    - A list of planned transfers
+    """
+    plans = [plan_tail_transfer(vm_info, remote_path, host_dir) for remote_path in remote_paths_list
+             if profiles.normalize_path(remote_path) in tail_paths]
+    remote_paths_list = [remote_path for remote_path in remote_paths_list
+                         if profiles.normalize_path(remote_path) not in tail_paths]
+    if batch_remote_paths and len(remote_paths_list) > 1:
+        os.makedirs(host_dir, exist_ok=True)
+        # One session per profile, as the rsync options apply to the whole session
+        paths_by_profile = {}
+        for remote_path in remote_paths_list:
+            paths_by_profile.setdefault(profiles.profile_for(remote_path, path_profiles), []).append(remote_path)
+        return plans + [{
+            'remote_paths': paths,
+            'command': build_batch_rsync_command(vm_info, paths, host_dir, profile),
+        } for profile, paths in paths_by_profile.items()]
+    for remote_path in remote_paths_list:
+        # Construct the local path by appending the remote path to the base local directory
+        local_path = os.path.join(host_dir, remote_path.lstrip('/'))
+        os.makedirs(local_path, exist_ok=True)
+        plans.append({
+            'remote_paths': [remote_path],
+            'command': build_rsync_command(vm_info, remote_path, local_path),
+        })
+    return plans
+
+# Function to build the command of the file watcher of a VM
+def build_watch_command(vm_info):
+    """
+    Build the ssh command running inotifywait on a VM, printing the path of every changed file
+    """
+    remote_command = shlex.join([sudo_path, 'inotifywait', '-m', '-r', '-q', '-e', 'close_write', '-e', 'moved_to',
+                                 '--format', '%w%f', *vm_info['remote_paths']])
+    return get_ssh_command(vm_info) + [f"{vm_info['username']}@{vm_info['hostname']}", remote_command]
+
+# Function to build the rsync command copying a list of remote files
+def build_files_rsync_command(vm_info, files_from, host_dir, profile=profiles.DEFAULT_PROFILE):
+    """
+    Build the rsync argv list copying the remote files listed in a local file
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - files_from: The local file listing the remote files, relative to /
+    - host_dir: The local directory of the VM, i.e. <base_local_dir>/<hostname>
+    - profile: The name of the transfer profile of the files
+    Returns:
+    - The rsync command as a list of arguments
+    """
+    ssh_command = shlex.join(get_ssh_command(vm_info))
+    return [
+        'rsync', '-a', '--stats', *rsync_profiles[profile],
+        # A file may be gone again by the time it is copied
+        f"--files-from={files_from}", '--ignore-missing-args',
+        '-e', ssh_command,
+        f"--rsync-path={sudo_path} rsync",
+        f"{vm_info['username']}@{vm_info['hostname']}:/",
+        f"{host_dir}/",
+    ]
+
+# Function to copy the files reported by the file watcher of a VM
+def copy_changed_files(vm_info, changed_files):
+    """
+    Copy the files of a VM that changed since the previous push
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - changed_files: The set of remote files reported by the watcher
+    Returns:
+    - A list of transfer results
+
+    The digests of change detection are left to the polling cycles: a push copy only copies the
+    files the watcher reported, not every change below their remote path.
+    """
+    host_dir = os.path.join(base_local_dir, vm_info['hostname'])
+    files_by_path = {}
+    for remote_file in changed_files:
+        for remote_path in vm_info['remote_paths']:
+            if remote_file.startswith(profiles.normalize_path(remote_path).rstrip('/') + '/'):
+                files_by_path.setdefault(remote_path, []).append(remote_file)
+                break
+    results = []
+    with host_locks.get(vm_info['hostname']), group_limiter.hold(vm_info):
+        if dedup_store:
+            start_dedup_transfer(host_dir, list(files_by_path))
+        for remote_path, files in files_by_path.items():
+            if profiles.normalize_path(remote_path) in tail_paths:
+                plan = plan_tail_transfer(vm_info, remote_path, host_dir)
+                result = transfer.run_plan(plan, timeout=transfer_timeout)
+            else:
+                # --files-from implies --relative, /sc/run/a.log lands in <host_dir>/sc/run/a.log
+                with tempfile.NamedTemporaryFile('w', prefix='cc-fsync-files-', suffix='.txt') as files_from:
+                    files_from.write(''.join(f"{remote_file.lstrip('/')}\n" for remote_file in sorted(set(files))))
+                    files_from.flush()
+                    command = build_files_rsync_command(vm_info, files_from.name, host_dir,
+                                                        profiles.profile_for(remote_path, path_profiles))
+                    logger.info("Copying %d changed file(s) of %s from %s", len(files), remote_path,
+                                vm_info['hostname'])
+                    result = transfer.run_command(command, timeout=transfer_timeout)
+            result.update(hostname=vm_info['hostname'], remote_paths=[remote_path])
+            transfer.log_result(result)
+            results.append(result)
+            if not transfer.succeeded(result):
+                continue
+            if dedup_store:
+                deduplicate(host_dir, [remote_path])
+            if file_manifest:
+                index_files(vm_info['hostname'], host_dir, [remote_path])
+    return results
+
 # Function to connect to a VM and copy files using rsync
 def copy_files_from_vm(vm_info, local_dir):
     """
@@ -248,78 +1015,316 @@ def copy_files_from_vm(vm_info, local_dir):
     Parameters:
     - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
     - local_dir: The base local directory to copy the files to
+    Returns:
+    - A list of transfer results (see transfer.new_result), with the hostname and
+      remote_paths of each transfer added
 
-    The function constructs the rsync command and executes it locally to copy the files from the VM to the local directory.
+    The function constructs the rsync commands and executes them locally to copy the files from the VM to the local directory.
     """
+    results = []
     try:
-        for remote_path in vm_info['remote_paths']:
-            # Construct the local path by appending the remote path to the base local directory
-            local_path = os.path.join(local_dir, vm_info['hostname'], remote_path.lstrip('/'))
-            os.makedirs(local_path, exist_ok=True)
-
-            # Construct the rsync command with the specified sudo path
-            rsync_command = (
-                f"rsync -az -e 'ssh -o StrictHostKeyChecking=no -i {vm_info['key_filename']}' "
-                f"--rsync-path='{sudo_path} rsync' {vm_info['username']}@{vm_info['hostname']}:{remote_path}/ {local_path}/"
-            )
-            logger.info("Running command: %s", rsync_command)
-
-            # Execute the rsync command locally
-            os.system(rsync_command)
-        logger.info("Successfully copied files from %s to %s", vm_info['hostname'], local_path)
+        for plan in plan_transfers(vm_info, local_dir):
+            if not transfer.can_run(plan, results):
+                logger.info("Skipping %s of %s, not every transfer succeeded", ', '.join(plan['remote_paths']),
+                            vm_info['hostname'])
+                continue
+            logger.info("Running command: %s", shlex.join(plan['command']))
+            # Execute the rsync command locally, or the transfer of the SFTP backend
+            result = transfer.run_plan(plan, timeout=transfer_timeout)
+            result.update(hostname=vm_info['hostname'], remote_paths=plan['remote_paths'],
+                          local=plan.get('local', False))
+            transfer.log_result(result)
+            results.append(result)
+            if result['cancelled']:
+                break
     except Exception as r_error:
-        logger.error("Failed to copy files from %s: %s", vm_info['hostname'], r_error)
+        result = transfer.new_result([])
+        result.update(hostname=vm_info['hostname'], remote_paths=list(vm_info['remote_paths']), error=str(r_error))
+        transfer.log_result(result)
+        results.append(result)
+    return results
+
+# Function to copy the files of a VM within the per-zone/subnet limits
+def copy_files_from_vm_limited(vm_info, local_dir, on_vm_done=None):
+    """
+    Wait for a free slot in the zone and subnet of a VM and copy its files
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - local_dir: The base local directory to copy the files to
+    - on_vm_done: An optional function called with vm_info once the VM is done
+    Returns:
+    - A list of transfer results
+    """
+    try:
+        # Wait for the VM before taking its zone/subnet and global slots
+        with host_locks.get(vm_info['hostname']), group_limiter.hold(vm_info):
+            return copy_files_from_vm(vm_info, local_dir)
+    finally:
+        if on_vm_done:
+            on_vm_done(vm_info)
+
+# Function to log a summary of the transfers of one copy cycle
+def log_cycle_summary(results, duration):
+    """
+    Log the number of transfers, failures and bytes moved in a copy cycle
+    Parameters:
+    - results: A list of transfer results
+    - duration: The duration of the cycle in seconds
+    """
+    failed = [result for result in results if not transfer.succeeded(result)]
+    total_bytes = sum(result['bytes_transferred'] for result in results)
+    logger.info("Copy cycle finished in %.1fs: %d transfers, %d failed, %d bytes received",
+                duration, len(results), len(failed), total_bytes)
+
+# Function to validate the inventory setting
+def validate_inventory(sources):
+    """
+    Validate the inventory setting
+    Parameters:
+    - sources: A list of inventory sources, e.g.
+      {"type": "asg", "name": "cc-asg" or ["cc-asg-1", "cc-asg-2"], "region": "us-east-1"}
+      {"type": "vmss", "name": "cc-vmss", "resource_group": "cc-rg", "subscription_id": "..."}
+      {"type": "static", "hosts": ["10.0.0.10", "10.0.0.11"]}
+    Raises:
+    - ValueError if a source is invalid
+    """
+    required_keys = {
+        'asg': ('name', 'region'),
+        'vmss': ('name', 'resource_group', 'subscription_id'),
+        'static': ('hosts',),
+    }
+    for index, source in enumerate(sources):
+        source_type = source.get('type')
+        if source_type not in required_keys:
+            raise ValueError(f"inventory[{index}]: unsupported type '{source_type}', expected one of {', '.join(required_keys)}")
+        missing = [key for key in required_keys[source_type] if not source.get(key)]
+        if missing:
+            raise ValueError(f"inventory[{index}]: missing {', '.join(missing)}")
+
+# Function to get the VMs of one inventory source
+def get_source_vm_list(source):
+    """
+    Get the list of VMs of one inventory source (see validate_inventory)
+    """
+    if source['type'] == 'asg':
+        return get_asg_instances(source['name'], source['region'])
+    if source['type'] == 'vmss':
+        return get_vmss_instances(source['name'], source['resource_group'], source['subscription_id'])
+    return get_static_vm_list(source['hosts'])
+
+# Function to get the VMs of all inventory sources
+def get_inventory_vm_list(sources):
+    """
+    Discover all inventory sources concurrently and merge them into one list
+    Parameters:
+    - sources: The validated inventory setting
+    Returns:
+    - The list of VMs, without duplicate hostnames. If the same hostname is found in several
+      sources, the first source in the inventory setting wins. A source that failed contributes
+      the VMs of its last successful discovery. None if every source failed.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(len(sources), discovery_concurrency))) as executor:
+        source_vm_lists = list(executor.map(get_source_vm_list, sources))
+    if all(source_vm_list is None for source_vm_list in source_vm_lists):
+        return None
+    for index, source_vm_list in enumerate(source_vm_lists):
+        if source_vm_list is None:
+            # One bad region or subscription must not stop the copies of the other sources
+            source_vm_lists[index] = last_source_vm_lists.get(index, [])
+            logger.error("Discovery of inventory[%d] (%s) failed, keeping its %d known VM(s)",
+                         index, sources[index]['type'], len(source_vm_lists[index]))
+        else:
+            last_source_vm_lists[index] = source_vm_list
+    vm_list = []
+    seen = set()
+    for source_vm_list in source_vm_lists:
+        for vm_info in source_vm_list:
+            if vm_info['hostname'] not in seen:
+                seen.add(vm_info['hostname'])
+                vm_list.append(vm_info)
+    return vm_list
 
 # Function to get the VM list
 def get_vm_list():
     """
-    Get the list of VMs based on the cloud environment
+    Get the list of VMs from the inventory sources, or else based on the cloud environment
+    Returns:
+    - The list of VMs, or None if the discovery failed
     """
-    if settings.get('cc_vms'):
+    if inventory_sources:
+        return get_inventory_vm_list(inventory_sources)
+    if settings.get('cc_vms') or cloud_override == 'static':
         return get_static_vm_list()
-    cloud_env = detect_cloud_environment()
+    cloud_env = get_cloud_environment()
     if cloud_env == 'aws':
         return get_asg_instances()
     if cloud_env == 'azure':
         return get_vmss_instances()
     print("Unsupported cloud environment")
-    return []
+    return None
+
+# Function to discover the VMs
+def discover_vms():
+    """
+    Refresh the inventory cache
+    Returns:
+    - A diff with the added, removed and unchanged VMs (see inventory.new_diff)
+    """
+    global cycle_id
+    if file_manifest:
+        # The per_vm scheduling has no end of cycle; report the previous cycle before starting a new one
+        write_drift_report()
+        cycle_id = file_manifest.new_cycle()
+    diff = inventory_cache.refresh()
+    if not inventory.vms_to_copy(diff):
+        logger.info("No instances found")
+    if watch_manager:
+        watch_manager.update(inventory.current_members(diff))
+    return diff
+
+# Function to release the resources of a VM that left
+def release_vm(vm_info):
+    """
+    Close the SSH connections of a VM that left the ASG/VMSS after its final copy and forget its
+    tail offsets, digests and manifest rows
+    """
+    # Wait for a copy of the VM that is still running, e.g. in an overlapping cycle, before its
+    # connections are torn down
+    with host_locks.get(vm_info['hostname']):
+        if ssh_pool:
+            ssh_pool.close(vm_info['hostname'])
+        if sftp_backend:
+            sftp_backend.close(vm_info['hostname'])
+        if watch_manager:
+            watch_manager.stop(vm_info['hostname'])
+        # The IP address may be reused by a new VM, whose files start at offset 0
+        state.remove(get_tail_state_file(vm_info['hostname']))
+        if digest_manifest:
+            digest_manifest.remove(vm_info['hostname'])
+        if file_manifest:
+            file_manifest.remove_host(vm_info['hostname'])
+
+# File watchers of the VMs in push mode, updated by discover_vms
+watch_manager = WatchManager(build_watch_command, copy_changed_files, push_debounce) \
+    if push_mode and not sftp_backend else None
+# Last known VM membership, refreshed by discover_vms
+inventory_cache = inventory.InventoryCache(get_vm_list, inventory_ttl)
+# Consumer of the ASG lifecycle notifications, started by start_lifecycle_events
+lifecycle_consumer = None
 
 # Function to run the copy process for all VMs concurrently
-def run_copy_process():
+def run_copy_process(vm_filter=None, on_vm_done=None):
     """
     Run the copy process for all VMs concurrently
+    Parameters:
+    - vm_filter: An optional function selecting the VMs to copy from the discovered list
+    - on_vm_done: An optional function called with the vm_info of every VM once it is done
     """
-    vm_list = get_vm_list()
+    start = time.monotonic()
+    diff = discover_vms()
+    # New VMs are copied right away, departed VMs get one final drain copy
+    vm_list = inventory.vms_to_copy(diff)
+    for vm_info in diff['removed']:
+        logger.info("Final copy of %s before it leaves the inventory", vm_info['hostname'])
     if not vm_list:
-        logger.info("No instances found")
         return
+    if vm_filter:
+        vm_list = vm_filter(vm_list)
+    if concurrency_limits:
+        # Spread the VMs of each zone over the cycle so workers don't queue on one zone
+        vm_list = limits.interleave(vm_list)
+    results = []
     if CONCURRENCY_MODEL == 'thread':
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(copy_files_from_vm, vm_info, base_local_dir) for vm_info in vm_list]
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [executor.submit(copy_files_from_vm_limited, vm_info, base_local_dir, on_vm_done)
+                       for vm_info in vm_list]
             for future in as_completed(futures):
-                future.result()
+                results.extend(future.result())
+    elif CONCURRENCY_MODEL == 'asyncio':
+        results = asyncio.run(async_engine.copy_files_from_vms(
+            vm_list, lambda vm_info: plan_transfers(vm_info, base_local_dir), max_concurrency, group_limiter,
+            host_locks, concurrency_limits, transfer_timeout, on_vm_done))
     elif CONCURRENCY_MODEL == 'gevent':
-        jobs = [gevent.spawn(copy_files_from_vm, vm_info, base_local_dir) for vm_info in vm_list]
+        pool = gevent.pool.Pool(max_concurrency)
+        jobs = [pool.spawn(copy_files_from_vm_limited, vm_info, base_local_dir, on_vm_done) for vm_info in vm_list]
         gevent.joinall(jobs)
+        for job in jobs:
+            results.extend(job.value or [])
     else:
         # run sequentially
         for vm_info in vm_list:
-            copy_files_from_vm(vm_info, base_local_dir)
+            results.extend(copy_files_from_vm_limited(vm_info, base_local_dir, on_vm_done))
+    for vm_info in diff['removed']:
+        # Drained VMs were released by the lifecycle consumer after their final copy
+        if not vm_info.get('drained'):
+            release_vm(vm_info)
+    if ssh_pool:
+        # Tear down the connections of VMs that left the ASG/VMSS
+        ssh_pool.prune(inventory.current_members(diff), host_locks)
+    if sftp_backend:
+        sftp_backend.prune(inventory.current_members(diff), host_locks)
+    log_cycle_summary(results, time.monotonic() - start)
+    write_drift_report()
 
+# Function to start following ASG lifecycle hook notifications
+def start_lifecycle_events():
+    """
+    Start consuming ASG lifecycle notifications when inventory_mode is 'events'
+    """
+    global lifecycle_consumer
+    if inventory_mode != 'events':
+        return
+    region = settings.get('lifecycle_region') or aws_region
+    lifecycle_consumer = LifecycleConsumer(
+        clients.get_aws_client('sqs', region, settings.get('sqs_endpoint_url')),
+        clients.get_aws_client('autoscaling', region),
+        settings['lifecycle_queue_url'],
+        inventory_cache,
+        lambda instance_id: get_ec2_vm_info(instance_id, region),
+        lambda vm_info: copy_files_from_vm_limited(vm_info, base_local_dir),
+        release_vm,
+        settings.get('lifecycle_heartbeat_interval', 60))
+    lifecycle_consumer.start()
 
-# Set the cloud environment
-CLOUD_ENV = detect_cloud_environment()
+# Function to stop following ASG lifecycle hook notifications
+def stop_lifecycle_events():
+    """
+    Stop consuming ASG lifecycle notifications
+    """
+    if lifecycle_consumer:
+        lifecycle_consumer.stop()
 
-if CLOUD_ENV is None:
-    logger.critical("Failed to detect cloud environment. Exiting.")
+# Function to close all persistent connections
+def close_connections():
+    """
+    Stop the file watchers and close the persistent SSH and SFTP connections to all VMs
+    """
+    if watch_manager:
+        watch_manager.stop_all()
+    if ssh_pool:
+        ssh_pool.close_all()
+    if sftp_backend:
+        sftp_backend.close_all()
+
+
+try:
+    validate_inventory(inventory_sources)
+except ValueError as inventory_error:
+    logger.critical("Invalid inventory setting: %s", inventory_error)
     sys.exit(1)
 
-# Schedule the copy process to run periodically
-schedule.every(interval).seconds.do(run_copy_process)
+# Set the cloud environment. The inventory sources already say where every VM is.
+if not inventory_sources:
+    CLOUD_ENV = get_cloud_environment()
+
+    if CLOUD_ENV is None:
+        logger.critical("Failed to detect cloud environment. Exiting.")
+        sys.exit(1)
 
 # Main loop to keep the script running and executing the scheduled tasks
 if __name__ == "__main__":
+    # Schedule the copy process to run periodically
+    schedule.every(interval).seconds.do(run_copy_process)
     while True:
         schedule.run_pending()
         time.sleep(1)
@@ -0,0 +1,235 @@
+"""
+This module copies append-only log directories by fetching only the bytes added since the last cycle.
+
+rsync reads and checksums every changed file completely, which makes the work per cycle grow with
+the size of the logs instead of with the amount of new data. For the remote paths listed in the
+tail_paths setting, one ssh command lists the inode and size of every remote file, and the new
+bytes of each grown file are streamed with 'tail -c +N' straight into the local copy. The byte
+offset and inode of every file are kept in a state file. A file whose inode changed or that shrank
+was rotated or truncated and is fetched again from the start; a file that was renamed by a
+rotation continues from the local copy of its previous name.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import time
+
+from cc_fsync import state, transfer
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Lists "<inode> <size> <path>" for every file below $1, with GNU or BSD stat
+LIST_SCRIPT = ('cd "$1" && find . -type f -exec sh -c '
+               '\'stat -c "%i %s %n" "$@" 2>/dev/null || stat -f "%i %z %N" "$@"\' sh {} +')
+
+
+class TransferAborted(Exception):
+    """
+    Raised when the deadline passed or the daemon is shutting down
+    """
+
+
+class RemoteCommandError(Exception):
+    """
+    Raised when a remote command exits with an error
+    """
+
+
+# Function to run one ssh command with the deadline of the transfer
+def run_remote(argv, deadline, stdout=subprocess.PIPE):
+    """
+    Run an ssh command, killing it when the deadline passes or on shutdown
+    Parameters:
+    - argv: The command as a list of arguments
+    - deadline: The time.monotonic() value the command must finish by, or None
+    - stdout: Where the output goes, e.g. an open local file
+    Returns:
+    - The output as bytes if stdout is subprocess.PIPE, else None
+    """
+    process = subprocess.Popen(argv, stdout=stdout, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                               start_new_session=True)
+    if not transfer.track_process(process):
+        transfer.terminate_process(process)
+        process.communicate()
+        raise TransferAborted()
+    try:
+        try:
+            output, error = process.communicate(timeout=None if deadline is None
+                                                else max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            transfer.terminate_process(process)
+            process.communicate()
+            raise TransferAborted()
+    finally:
+        transfer.untrack_process(process)
+    if transfer.is_cancelled() and process.returncode != 0:
+        raise TransferAborted()
+    if process.returncode != 0:
+        raise RemoteCommandError(error.decode(errors='replace').strip()[-2000:] or
+                                 f"exit code {process.returncode}")
+    return output
+
+
+# Function to list the files of a remote directory
+def list_remote_files(ssh_command, sudo_path, remote_path, deadline):
+    """
+    List the inode and size of every file below a remote directory
+    Parameters:
+    - ssh_command: The ssh command including the destination, as a list of arguments
+    - sudo_path: The path of sudo on the VM
+    - remote_path: The remote directory
+    - deadline: The time.monotonic() value the listing must finish by, or None
+    Returns:
+    - A dictionary mapping the path relative to remote_path to an (inode, size) tuple
+    """
+    remote_command = shlex.join([sudo_path, 'sh', '-c', LIST_SCRIPT, 'sh', remote_path])
+    output = run_remote(ssh_command + [remote_command], deadline)
+    files = {}
+    for line in output.decode(errors='surrogateescape').splitlines():
+        parts = line.split(' ', 2)
+        if len(parts) != 3 or not parts[0].isdigit() or not parts[1].isdigit():
+            continue
+        relative_path = parts[2][2:] if parts[2].startswith('./') else parts[2]
+        files[relative_path] = (int(parts[0]), int(parts[1]))
+    return files
+
+
+# Function to copy the new bytes of a directory of append-only files
+def tail_sync(ssh_command, sudo_path, remote_path, local_path, state_file, timeout=None):
+    """
+    Fetch the bytes appended to the files of a remote directory since the previous call
+    Parameters:
+    - ssh_command: The ssh command including the destination, as a list of arguments
+    - sudo_path: The path of sudo on the VM
+    - remote_path: The remote directory to copy
+    - local_path: The local directory to copy the files to
+    - state_file: The JSON file holding the offsets of the files of the VM
+    - timeout: The maximum number of seconds the transfer may run, or None for no limit
+    Returns:
+    - A result dictionary (see transfer.new_result)
+    """
+    result = transfer.new_result(['tail', *ssh_command[-1:], remote_path])
+    if transfer.is_cancelled():
+        result['cancelled'] = True
+        return result
+    start = time.monotonic()
+    deadline = start + timeout if timeout else None
+    offsets = state.read_json(state_file, {})
+    previous = offsets.get(remote_path, {})
+    current = {}
+    try:
+        remote_files = list_remote_files(ssh_command, sudo_path, remote_path, deadline)
+        inodes = {entry['inode']: relative_path for relative_path, entry in previous.items()}
+        # Renamed files first, before their old name is overwritten with the content of a new file
+        order = sorted(remote_files, key=lambda relative_path: relative_path in previous)
+        for relative_path in order:
+            inode, size = remote_files[relative_path]
+            target = os.path.join(local_path, relative_path)
+            offset = start_offset(previous, inodes, relative_path, inode, size, local_path)
+            if offset < size:
+                offset = fetch(ssh_command, sudo_path, f"{remote_path.rstrip('/')}/{relative_path}",
+                               target, offset, size - offset, deadline, result)
+            current[relative_path] = {'inode': inode, 'offset': offset}
+        result['exit_code'] = 0
+    except TransferAborted:
+        result['exit_code'] = 1
+        result['cancelled'] = transfer.is_cancelled()
+        result['timed_out'] = not result['cancelled']
+    except (OSError, RemoteCommandError) as tail_error:
+        result['exit_code'] = 1
+        result['error'] = str(tail_error)
+    # Keep the offsets of the files done so far, the rest continues next cycle
+    if result['exit_code'] != 0:
+        current = dict(previous, **current)
+    offsets[remote_path] = current
+    state.write_json(state_file, offsets)
+    result['duration'] = time.monotonic() - start
+    return result
+
+
+# Function to find where the local copy of a remote file continues
+def start_offset(previous, inodes, relative_path, inode, size, local_path):
+    """
+    Return the offset the copy of a remote file continues from
+    Parameters:
+    - previous: The offsets of the previous cycle, by relative path
+    - inodes: The relative paths of the previous cycle, by inode
+    - relative_path: The path of the file relative to the remote directory
+    - inode, size: The inode and size of the remote file
+    - local_path: The local directory of the remote directory
+    Returns:
+    - The number of bytes of the file that are already copied
+    """
+    target = os.path.join(local_path, relative_path)
+    entry = previous.get(relative_path)
+    if entry and entry['inode'] == inode and entry['offset'] <= size:
+        return entry['offset'] if local_size(target) == entry['offset'] else 0
+    # Rotated by a rename: continue from the local copy of the old name
+    old_path = inodes.get(inode)
+    if old_path and old_path != relative_path and previous[old_path]['offset'] <= size:
+        old_target = os.path.join(local_path, old_path)
+        if local_size(old_target) == previous[old_path]['offset']:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(old_target, target)
+            return previous[old_path]['offset']
+    if entry is None and local_size(target) == size:
+        # Copied before tail mode knew the file, e.g. by the seed of a new VM
+        return size
+    return 0
+
+
+# Function to get the size of a local file
+def local_size(path):
+    """
+    Return the size of a local file, or None if it does not exist
+    """
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return None
+
+
+# Function to fetch a byte range of a remote file
+def fetch(ssh_command, sudo_path, remote_file, target, offset, length, deadline, result):
+    """
+    Stream length bytes of a remote file from offset into the local file
+    Returns:
+    - The new offset, i.e. the size of the local file
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    remote_command = (f"{shlex.join([sudo_path, 'tail', '-c', f'+{offset + 1}', remote_file])}"
+                      f" | {shlex.join(['head', '-c', str(length)])}")
+    with open(target, 'r+b' if offset and os.path.exists(target) else 'wb') as f_stream:
+        f_stream.truncate(offset)
+        f_stream.seek(offset)
+        # ssh writes straight into the local file
+        run_remote(ssh_command + [remote_command], deadline, stdout=f_stream)
+        new_offset = os.fstat(f_stream.fileno()).st_size
+    result['bytes_transferred'] += new_offset - offset
+    return new_offset
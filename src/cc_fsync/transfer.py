@@ -0,0 +1,304 @@
+"""
+This module runs the external commands used to move files off the CC VMs (rsync, ssh, tar).
+
+Commands are always executed from an argv list, never through a shell. Every run returns a
+structured result, is bounded by an optional deadline and can be cancelled from another
+thread (for example from the signal handler when the daemon shuts down).
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Seconds to wait after SIGTERM before a process group is killed
+KILL_GRACE_PERIOD = 5
+
+# Exit code of rsync when source files vanished during the transfer, e.g. rotated logs
+RSYNC_VANISHED = 24
+
+# Matches the "Total bytes received" line printed by rsync --stats
+RSYNC_BYTES_RECEIVED = re.compile(r'Total bytes received:\s*([\d,.]+)')
+
+# Set once the daemon is shutting down; no new commands are started afterwards
+_shutdown_event = threading.Event()
+# Processes that are currently running, so they can be cancelled on shutdown
+_active_processes = set()
+_active_lock = threading.RLock()
+
+
+# Function to build an empty result for a command
+def new_result(argv):
+    """
+    Create the result dictionary returned for every command
+    Parameters:
+    - argv: The command that was (or would have been) executed
+    Returns:
+    - A dictionary with the command, exit_code, duration, bytes_transferred,
+      timed_out, cancelled and error keys
+    """
+    return {
+        'command': list(argv),
+        'exit_code': None,
+        'duration': 0.0,
+        'bytes_transferred': 0,
+        'timed_out': False,
+        'cancelled': False,
+        'error': None,
+    }
+
+
+# Function to parse the number of bytes received from rsync --stats output
+def parse_rsync_bytes(output):
+    """
+    Parse the number of bytes received from the output of rsync --stats
+    Parameters:
+    - output: The stdout of the rsync command
+    Returns:
+    - The number of bytes received, or 0 if it could not be found
+    """
+    match = RSYNC_BYTES_RECEIVED.search(output or '')
+    if not match:
+        return 0
+    digits = re.sub(r'\D', '', match.group(1))
+    return int(digits) if digits else 0
+
+
+# Function to stop a running process and all of its children
+def terminate_process(process, wait=None):
+    """
+    Terminate a process group started by run_command, escalating to SIGKILL
+    Parameters:
+    - process: The process to terminate, started in its own session
+    - wait: A function waiting at most the given number of seconds for the process to exit,
+      raising TimeoutError otherwise. Defaults to Popen.wait.
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            return
+        try:
+            if wait:
+                wait(KILL_GRACE_PERIOD)
+            else:
+                process.wait(timeout=KILL_GRACE_PERIOD)
+            return
+        except (subprocess.TimeoutExpired, TimeoutError):
+            continue
+
+
+# Function to register a process so it can be cancelled
+def track_process(process):
+    """
+    Register a running process; returns False if a shutdown is already in progress
+    """
+    with _active_lock:
+        if _shutdown_event.is_set():
+            return False
+        _active_processes.add(process)
+        return True
+
+
+# Function to unregister a process once it exited
+def untrack_process(process):
+    """
+    Unregister a process that was registered with track_process
+    """
+    with _active_lock:
+        _active_processes.discard(process)
+
+
+# Function to run a command with a deadline
+def run_command(argv, timeout=None, parse_output=parse_rsync_bytes):
+    """
+    Run a command from an argv list and wait for it to finish
+    Parameters:
+    - argv: The command and its arguments as a list
+    - timeout: The maximum number of seconds the command may run, or None for no limit
+    - parse_output: A function returning the number of bytes moved from the command stdout
+    Returns:
+    - A result dictionary (see new_result)
+    """
+    result = new_result(argv)
+    if _shutdown_event.is_set():
+        result['cancelled'] = True
+        return result
+
+    start = time.monotonic()
+    try:
+        # Start a new session so that ssh spawned by rsync is terminated together with it
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   stdin=subprocess.DEVNULL, text=True, start_new_session=True)
+    except OSError as os_error:
+        result['error'] = str(os_error)
+        return result
+
+    if not track_process(process):
+        terminate_process(process)
+        process.communicate()
+        result['cancelled'] = True
+        return result
+
+    try:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            result['timed_out'] = True
+            terminate_process(process)
+            stdout, stderr = process.communicate()
+    finally:
+        untrack_process(process)
+
+    result['duration'] = time.monotonic() - start
+    result['exit_code'] = process.returncode
+    result['cancelled'] = _shutdown_event.is_set() and process.returncode != 0
+    if parse_output:
+        result['bytes_transferred'] = parse_output(stdout)
+    if process.returncode != 0:
+        result['error'] = (stderr or '').strip()[-2000:] or None
+    return result
+
+
+# Function to run one planned transfer
+def run_plan(plan, timeout=None):
+    """
+    Run a transfer planned by sync.plan_transfers
+    Parameters:
+    - plan: A dictionary with the command to run, or with a run function taking the timeout
+      (transfer backends that don't fork a command), and an optional on_success function. Plans
+      with local set work on the local copy only and must be skipped unless every earlier
+      transfer of the VM succeeded (see can_run).
+    - timeout: The maximum number of seconds the transfer may run, or None for no limit
+    Returns:
+    - A result dictionary (see new_result)
+    """
+    if 'run' in plan:
+        result = plan['run'](timeout)
+    else:
+        result = run_command(plan['command'], timeout=timeout)
+    complete_plan(plan, result)
+    return result
+
+
+# Function to run the success callback of a planned transfer
+def complete_plan(plan, result):
+    """
+    Call the on_success function of a plan, e.g. to record what was copied, if the transfer succeeded
+    """
+    if succeeded(result) and plan.get('on_success'):
+        try:
+            plan['on_success']()
+        except Exception as callback_error:
+            # The files were copied; only the bookkeeping failed (disk full, database locked, ...)
+            logger.error("Failed to complete the transfer of %s: %s", ', '.join(plan['remote_paths']),
+                         callback_error)
+
+
+# Function to check if a planned transfer may run after the earlier transfers of its VM
+def can_run(plan, results):
+    """
+    Return False for a local plan if one of the earlier results of the VM did not succeed
+    """
+    return not plan.get('local') or all(succeeded(result) for result in results)
+
+
+# Function to check if a result represents a successful run
+def succeeded(result):
+    """
+    Return True if the command finished with exit code 0 within its deadline. rsync also succeeds
+    when only files that vanished during the transfer were not copied.
+    """
+    return (result['exit_code'] == 0 or vanished(result)) and not result['timed_out'] and not result['cancelled']
+
+
+# Function to check if rsync could not copy files that vanished meanwhile
+def vanished(result):
+    """
+    Return True if rsync reported files that vanished during the transfer
+    """
+    return result['exit_code'] == RSYNC_VANISHED and result['command'][:1] == ['rsync']
+
+
+# Function to log the outcome of a transfer
+def log_result(result):
+    """
+    Log the outcome of a transfer
+    Parameters:
+    - result: A transfer result with the hostname and remote_paths keys set, and local set for
+      the results of local plans
+    """
+    paths = ', '.join(result['remote_paths'])
+    if result.get('local'):
+        if succeeded(result):
+            logger.info("Created %s of %s in %.1fs", paths, result['hostname'], result['duration'])
+        elif not result['cancelled']:
+            logger.error("Failed to create %s of %s (exit code %s): %s",
+                         paths, result['hostname'], result['exit_code'], result['error'])
+    elif succeeded(result) and vanished(result):
+        logger.warning("Copied %s from %s (%d bytes in %.1fs), some files vanished meanwhile: %s",
+                       paths, result['hostname'], result['bytes_transferred'], result['duration'], result['error'])
+    elif succeeded(result):
+        logger.info("Successfully copied %s from %s (%d bytes in %.1fs)",
+                    paths, result['hostname'], result['bytes_transferred'], result['duration'])
+    elif result['cancelled']:
+        logger.info("Cancelled copying %s from %s", paths, result['hostname'])
+    elif result['timed_out']:
+        logger.error("Timed out copying %s from %s after %.1fs",
+                     paths, result['hostname'], result['duration'])
+    else:
+        logger.error("Failed to copy %s from %s (exit code %s): %s",
+                     paths, result['hostname'], result['exit_code'], result['error'])
+
+
+# Function to cancel every running command
+def cancel_all():
+    """
+    Cancel all running commands and refuse to start new ones.
+    Safe to call from a signal handler or from another thread.
+    """
+    _shutdown_event.set()
+    with _active_lock:
+        processes = list(_active_processes)
+    for process in processes:
+        logger.info("Cancelling command with pid %s", process.pid)
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+# Function to check whether cancel_all was called
+def is_cancelled():
+    """
+    Return True once cancel_all has been called
+    """
+    return _shutdown_event.is_set()
@@ -0,0 +1,196 @@
+"""
+This module keeps a file watcher running on every CC VM and copies changed files as they change.
+
+In push mode one long-running 'inotifywait -m' per VM is started over ssh (reusing the multiplexed
+connection of the VM) and prints the path of every file that was written or moved into the
+remote paths. The events are collected for a short debounce delay and then handed over in one
+batch, so a burst of writes to a log file results in a single transfer of the files that
+changed. The regular polling cycles keep running as a safety net, e.g. while an agent restarts.
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Author: Shailendra Dharmistan, Zcaler Inc.
+"""
+
+import logging
+import subprocess
+import threading
+import time
+
+from cc_fsync import transfer
+
+# Get the logger that was created in __main__.py
+logger = logging.getLogger('__main__')
+
+# Seconds to wait before an agent that exited is started again
+RESTART_DELAY = 30
+# A batch of changes is handed over at the latest this many debounce delays after its first event
+MAX_DELAY_FACTOR = 5
+
+
+class WatchAgent:
+    """
+    File watcher running on one VM
+    Parameters:
+    - vm_info: A dictionary containing the hostname, username, key_filename, and remote_paths
+    - command: The ssh command starting the watcher, printing one changed path per line
+    - on_changes: A function called with vm_info and the set of changed remote files
+    - debounce: The number of seconds without new events before the changes are handed over
+    """
+
+    def __init__(self, vm_info, command, on_changes, debounce=2):
+        self.vm_info = vm_info
+        self.command = command
+        self.on_changes = on_changes
+        self.debounce = debounce
+        self._changes = set()
+        self._first_event = None
+        self._last_event = None
+        self._process = None
+        self._stopped = threading.Event()
+        self._condition = threading.Condition()
+
+    def start(self):
+        """
+        Start the watcher and the thread handing over the changes
+        """
+        hostname = self.vm_info['hostname']
+        threading.Thread(target=self._watch, name=f"cc-fsync-watch-{hostname}", daemon=True).start()
+        threading.Thread(target=self._flush, name=f"cc-fsync-push-{hostname}", daemon=True).start()
+
+    def stop(self):
+        """
+        Stop the watcher; changes not handed over yet are left to the next polling cycle
+        """
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+        process = self._process
+        if process and process.poll() is None:
+            transfer.terminate_process(process)
+
+    def _watch(self):
+        while not self._stopped.is_set() and not transfer.is_cancelled():
+            try:
+                self._process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                                 stdin=subprocess.DEVNULL, text=True, start_new_session=True)
+            except OSError as os_error:
+                logger.error("Failed to start the file watcher on %s: %s", self.vm_info['hostname'], os_error)
+                self._stopped.wait(RESTART_DELAY)
+                continue
+            if not transfer.track_process(self._process):
+                transfer.terminate_process(self._process)
+                return
+            logger.info("Watching %s for changes", self.vm_info['hostname'])
+            try:
+                for line in self._process.stdout:
+                    path = line.rstrip('\n')
+                    if path:
+                        self._add(path)
+            finally:
+                self._process.wait()
+                transfer.untrack_process(self._process)
+            if not self._stopped.is_set():
+                logger.warning("File watcher on %s exited with code %s, restarting in %ss",
+                               self.vm_info['hostname'], self._process.returncode, RESTART_DELAY)
+                self._stopped.wait(RESTART_DELAY)
+
+    def _add(self, path):
+        with self._condition:
+            now = time.monotonic()
+            if not self._changes:
+                self._first_event = now
+            self._last_event = now
+            self._changes.add(path)
+            self._condition.notify()
+
+    def _flush(self):
+        while not self._stopped.is_set():
+            with self._condition:
+                while not self._stopped.is_set():
+                    now = time.monotonic()
+                    if self._changes:
+                        ready_at = min(self._last_event + self.debounce,
+                                       self._first_event + self.debounce * MAX_DELAY_FACTOR)
+                        if now >= ready_at:
+                            break
+                        self._condition.wait(ready_at - now)
+                    else:
+                        self._condition.wait()
+                if self._stopped.is_set():
+                    return
+                changes, self._changes = self._changes, set()
+            try:
+                self.on_changes(self.vm_info, changes)
+            except Exception as push_error:
+                logger.error("Failed to copy changed files from %s: %s", self.vm_info['hostname'], push_error)
+
+
+class WatchManager:
+    """
+    One WatchAgent per VM of the inventory
+    Parameters:
+    - build_command: A function returning the watcher command of a vm_info
+    - on_changes: A function called with a vm_info and the set of changed remote files
+    - debounce: The number of seconds without new events before the changes are handed over
+    """
+
+    def __init__(self, build_command, on_changes, debounce=2):
+        self.build_command = build_command
+        self.on_changes = on_changes
+        self.debounce = debounce
+        self._agents = {}
+        self._lock = threading.Lock()
+
+    def update(self, vm_list):
+        """
+        Start the agents of new VMs and stop the agents of VMs that left
+        Parameters:
+        - vm_list: The current list of VMs
+        """
+        current = {vm_info['hostname']: vm_info for vm_info in vm_list}
+        with self._lock:
+            gone = [self._agents.pop(hostname) for hostname in list(self._agents) if hostname not in current]
+            for hostname, vm_info in current.items():
+                if hostname not in self._agents and not transfer.is_cancelled():
+                    agent = self._agents[hostname] = WatchAgent(vm_info, self.build_command(vm_info),
+                                                                self.on_changes, self.debounce)
+                    agent.start()
+        for agent in gone:
+            agent.stop()
+
+    def stop(self, hostname):
+        """
+        Stop the agent of a VM
+        """
+        with self._lock:
+            agent = self._agents.pop(hostname, None)
+        if agent:
+            agent.stop()
+
+    def stop_all(self):
+        """
+        Stop every agent
+        """
+        with self._lock:
+            agents, self._agents = list(self._agents.values()), {}
+        for agent in agents:
+            agent.stop()